@@ -0,0 +1,182 @@
+""" Performance benchmarks for Mendelian_Monkeys.
+
+Runs the model with fixed seeds for every transmission mode across a ladder
+of population sizes, grid sizes and numbers of attractors, and records the
+throughput (time-steps per second), the time it took the run to stop (if it
+stopped within the step budget) and the peak memory of each case. Every case
+runs in a fresh process so that the memory figures do not carry over, and is
+repeated a few times; the fastest repeat is reported.
+
+    python benchmark.py [--out results.json] [--steps 100] [--repeat 3] [--quick] [--only social]
+    python benchmark.py --compare baseline.json [--threshold 0.2]
+
+With --compare the results are checked against an earlier results file and
+the script exits with a non zero status if the throughput of any case dropped
+by more than the threshold (a fraction, 0.2 = 20%).
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Model"))
+
+from model_definition import Mendelian_Monkeys
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+import subprocess
+import argparse
+import platform
+import resource
+import tempfile
+import json
+import time
+import io
+
+SEED = 20230101
+
+# (Na, grid width/height). The grid grows with the population so that the
+# density stays close to that of the published runs (100 agents on 20x20),
+# except for the last case, a low density population on a landscape large
+# enough to use the sparse grid (see grid.py).
+LADDER = [(100, 20), (1000, 60), (10000, 200), (1000, 1000)]
+
+MODES = {"social": [{}],
+         "inherited": [{}],
+         "asocial": [{"learn_rate": 2}],
+         "resource_attraction": [{"N_Resources": 10, "attraction": 25, "learn_rate": 2},
+                                 {"N_Resources": 300, "attraction": 25, "learn_rate": 2}]}
+
+
+def cases(quick=False, only=None):
+
+    """ Returns the benchmark cases as a list of dicts of model parameters """
+
+    ladder = LADDER[:2] if quick else LADDER
+    out = []
+
+    for trans_mode, variants in MODES.items():
+        if only is not None and trans_mode not in only:
+            continue
+        for Na, size in ladder:
+            for params in variants:
+                case = dict(trans_mode=trans_mode, Na=Na, width=size, height=size, **params)
+                case["name"] = "%s-Na%d-%dx%d-R%d" % (trans_mode, Na, size, size, params.get("N_Resources", 0))
+                out.append(case)
+
+    return out
+
+
+def run_case(case, max_steps):
+
+    """ Runs a single case and returns its measurements. Called in a worker
+    process of its own. """
+
+    params = {key: value for key, value in case.items() if key != "name"}
+
+    with tempfile.TemporaryDirectory() as runs_path, redirect_stdout(io.StringIO()):
+
+        start = time.perf_counter()
+        model = Mendelian_Monkeys(runs_path=runs_path, seed=SEED, **params)
+        setup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        while model.running and model.timestep < max_steps:
+            model.step()
+        seconds = time.perf_counter() - start
+
+    stopped = not model.running
+
+    return dict(case,
+                seed=SEED,
+                setup_seconds=setup,
+                steps=model.timestep,
+                seconds=seconds,
+                steps_per_second=model.timestep/seconds,
+                time_to_stop=setup + seconds if stopped else None,
+                stop_reason=model.model_stop if stopped else None,
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024)
+
+
+def git_commit():
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(max_steps=100, quick=False, only=None, repeat=3):
+
+    results = []
+
+    for case in cases(quick, only):
+        # A new process per repeat: peak memory is measured per case and no
+        # state (caches, allocator) is shared between cases.
+        repeats = []
+        for i in range(repeat):
+            with Pool(1) as pool:
+                repeats.append(pool.apply(run_case, (case, max_steps)))
+        result = max(repeats, key=lambda result: result["steps_per_second"])
+        print("%-45s %8.1f steps/s  %7.1f MB  %s" % (result["name"], result["steps_per_second"],
+                                                    result["peak_rss_mb"], result["stop_reason"] or ""))
+        results.append(result)
+
+    return {"commit": git_commit(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "max_steps": max_steps,
+            "repeat": repeat,
+            "cases": results}
+
+
+def regressions(results, baseline, threshold=.2):
+
+    """ Returns the cases whose throughput dropped by more than threshold
+    compared to the baseline results """
+
+    before = {case["name"]: case for case in baseline["cases"]}
+    failed = []
+
+    for case in results["cases"]:
+        if case["name"] not in before:
+            continue
+        ratio = case["steps_per_second"]/before[case["name"]]["steps_per_second"]
+        print("%-45s %6.2fx" % (case["name"], ratio))
+        if ratio < 1 - threshold:
+            failed.append(case["name"])
+
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark Mendelian_Monkeys")
+    parser.add_argument("--out", default=None, help="write the results to this JSON file")
+    parser.add_argument("--steps", type=int, default=100, help="time-steps per case, unless the run stops earlier")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest is reported")
+    parser.add_argument("--quick", action="store_true", help="skip the largest populations")
+    parser.add_argument("--only", nargs="+", choices=list(MODES), default=None, help="only benchmark these modes")
+    parser.add_argument("--compare", default=None, help="results JSON file to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=.2, help="largest allowed drop in throughput")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.steps, args.quick, args.only, args.repeat)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        failed = regressions(results, baseline, args.threshold)
+
+        if len(failed) > 0:
+            print("Throughput dropped by more than %d%%: %s" % (args.threshold*100, failed))
+            sys.exit(1)
+        else:
+            print("No regressions")
@@ -1,7 +1,13 @@
+import multiprocessing
 import sqlite3
+import hashlib
+import numbers
+import json
 import math
+import time
 import random
 import string
+import numpy
 
 
 ### Distribution Functions
@@ -10,6 +16,45 @@ def levy_number(l, u):
 
     return(l**(-u))
 
+
+class UniformStream:
+    """ Hands out uniform random numbers on [0, 1) one at a time. The numbers
+    are drawn in blocks from a numpy Generator and converted to python floats
+    so that a draw is a list lookup and a cursor increment rather than a call
+    into numpy. """
+
+    def __init__(self, seed=None, block_size=8192):
+
+        self.generator = numpy.random.default_rng(seed)
+        self.block_size = block_size
+        self.refill()
+
+    def refill(self):
+
+        self.block = self.generator.random(self.block_size).tolist()
+        self.cursor = 0
+
+    def uniform(self):
+
+        if self.cursor == self.block_size:
+            self.refill()
+
+        u = self.block[self.cursor]
+        self.cursor += 1
+        return u
+
+    def randint(self, a, b):
+
+        """ Returns an integer between a and b inclusive, like random.randint """
+
+        return a + int(self.uniform() * (b - a + 1))
+
+    def choice(self, seq):
+
+        """ Returns a random element of a non-empty sequence, like random.choice """
+
+        return seq[int(self.uniform() * len(seq))]
+
 ### Agent Functions
 
 def ClosestAgent(pos, list):
@@ -33,206 +78,335 @@ def ClosestAgent(pos, list):
     return pos_dists.index(min(pos_dists))
 
 
-### DataBase Functions
+def nearest_attractor_table(width, height, attractor_xy, max_chunk=1000000, rng=numpy.random):
+    """
+    :param width: width of the grid
+    :param height: height of the grid
+    :param attractor_xy: a list with the (x, y) location of each attractor
+    :param max_chunk: the maximum number of cell-attractor distances held in memory at once
+    :param rng: source of the random numbers used to break ties (numpy.random or a numpy Generator)
+    :return: a width x height array holding, for every grid cell, the index in attractor_xy of
+     the nearest attractor. When several attractors are equally near one of them is chosen at random,
+     with one random number drawn for each cell that has a tie.
+    """
 
-def get_random_alphanumeric_string(length):
-    letters_and_digits = string.ascii_letters + string.digits
-    result_str = ''.join((random.choice(letters_and_digits) for i in range(length)))
-    return result_str
+    xy = numpy.asarray(attractor_xy, dtype=numpy.int64).reshape(-1, 2)
+    n_cells = width * height
+    table = numpy.empty(n_cells, dtype=numpy.int64)
+    chunk = max(1, max_chunk // len(xy))
 
+    for start in range(0, n_cells, chunk):
 
-def create_DB(db_file):
-    """creates a database where all of the ABM data will be stored"""
-    try:
-        conn = sqlite3.connect(db_file)
-        c = conn.cursor()
+        cells = numpy.arange(start, min(start + chunk, n_cells))
+        x = (cells // height)[:, None]
+        y = (cells % height)[:, None]
 
-        run_data_table = """ CREATE TABLE IF NOT EXISTS run_data (
-                                run_id text PRIMARY KEY,
-                                datetime text,
-                                n_time_steps text,
-                                n_agents integer,
-                                life_span integer,
-                                asocial_rate numeric,
-                                social_rate numeric,
-                                inherit_rate numeric,
-                                max_ts integer,
-                                n_users); """
+        # Squared distances are kept as integers so that ties are exact.
+        d2 = (x - xy[:, 0]) ** 2 + (y - xy[:, 1]) ** 2
+        nearest = d2 == d2.min(axis=1, keepdims=True)
 
-        node_table = """ CREATE TABLE IF NOT EXISTS nodes (
-                                id integer,
-                                tool_user integer,
-                                learned_tool_use text,
-                                learning_method text,
-                                age integer); """
+        # The first of the nearest attractors, unless several are equally near:
+        # then the k-th of them is taken, with k drawn at random.
+        choice = nearest.argmax(axis=1)
+        n_nearest = nearest.sum(axis=1)
+        tied = numpy.flatnonzero(n_nearest > 1)
+        if len(tied) > 0:
+            k = (rng.random(len(tied)) * n_nearest[tied]).astype(numpy.int64)
+            choice[tied] = (nearest[tied].cumsum(axis=1) > k[:, None]).argmax(axis=1)
+        table[start:start + len(cells)] = choice
 
-        social_edges = """ CREATE TABLE IF NOT EXISTS social_edges (
-                                source text,
-                                target text); """
+    return table.reshape(width, height)
 
 
-        genetic_edges = """ CREATE TABLE IF NOT EXISTS genetic_edges (
-                                run_id text,
-                                time_step, integer,
-                                trees_available text);
-                                """
+def nearest_attractor(x, y, attractor_x, attractor_y, uniform):
+    """
+    :param x, y: a grid cell
+    :param attractor_x, attractor_y: arrays of the x and y of each attractor
+    :param uniform: function returning a uniform random number, used to break ties
+    :return: the index of the attractor nearest to the cell, chosen as nearest_attractor_table
+     does. For grids too large for a table: only the cells that are asked for are looked up.
+    """
 
-        c.execute(run_data_table)
-        c.execute(source_data_table)
-        c.execute(lithic_data_table)
-        c.execute(tree_data_table)
-        c.execute(environment_table)
+    d2 = (attractor_x - x) ** 2 + (attractor_y - y) ** 2
+    nearest = numpy.flatnonzero(d2 == d2.min())
+    if len(nearest) == 1:
+        return int(nearest[0])
+    return int(nearest[int(uniform() * len(nearest))])
 
 
+### DataBase Functions
 
-    except sqlite3.Error as e:
+def get_random_alphanumeric_string(length, rng=random):
+    letters_and_digits = string.ascii_letters + string.digits
+    result_str = ''.join((rng.choice(letters_and_digits) for i in range(length)))
+    return result_str
 
-        print(e)
 
-    finally:
+def new_seed():
+    """ Returns a fresh seed drawn from the operating system's entropy pool. Seeds stay
+    below 2**53 so that they are read back exactly when the run data is loaded into R. """
 
-        pass
-        #conn.close()
+    return random.SystemRandom().randrange(2**53)
 
-def connect_db(db_file):
-    a = 0
-    while a == 0:
 
-        try:
-            conn = sqlite3.connect(db_file)
-            return conn
-        except sqlite3.Error as e:
-            print(e)
+def make_run_id(seed, params, length=6):
+    """
+    :param seed: the seed of the run
+    :param params: dict of the settings of the run, as they are recorded in its run data
+    :param length: the number of characters of the id
+    :return: a run_id drawn from a hash of the seed and of params. Runs that share a seed but
+     not their settings get different ids, so they do not overwrite each other's output,
+     while a replay of a run (replay.py) gets the run's id back.
+    """
 
-        return None
+    # Numbers are hashed by value: replay.py reads them back from the run data as floats or numpy types.
+    key = json.dumps([int(seed), {name: float(value) if isinstance(value, numbers.Number) else value
+                                  for name, value in params.items()}], sort_keys=True, default=str)
+    return get_random_alphanumeric_string(length, random.Random(hashlib.sha256(key.encode()).digest()))
+
+
+# Tables of the run database. Every table is keyed by run_id.
+
+DB_TABLES = {
+    "run_data": """ CREATE TABLE IF NOT EXISTS run_data (
+                        run_id text PRIMARY KEY,
+                        datetime text,
+                        h integer,
+                        w integer,
+                        starting_users integer,
+                        n_time_steps integer,
+                        n_agents integer,
+                        n_attractors integer,
+                        a_learn_rate numeric,
+                        attractor_strength numeric,
+                        transmission_mech text,
+                        stop_reason text,
+                        seed integer,
+                        stop_policies text,
+                        event_driven integer,
+                        edge_mode text,
+                        grid text); """,
+
+    "nodes": """ CREATE TABLE IF NOT EXISTS nodes (
+                        run_id text,
+                        id integer,
+                        living integer,
+                        tool_user integer,
+                        learned_tool_use integer,
+                        tool_user_encounters integer,
+                        age_learned_tool_use integer,
+                        time_step_learned integer,
+                        learning_method text,
+                        age integer,
+                        mother integer,
+                        mother_tool_user integer,
+                        hair integer); """,
+
+    "social_edges": """ CREATE TABLE IF NOT EXISTS social_edges (
+                        run_id text,
+                        source integer,
+                        target integer); """,
+
+    "genetic_edges": """ CREATE TABLE IF NOT EXISTS genetic_edges (
+                        run_id text,
+                        source integer,
+                        target integer); """,
+
+    # Written instead of social_edges by runs with edge_mode = "weighted" (see edge_log.py)
+
+    "social_edge_weights": """ CREATE TABLE IF NOT EXISTS social_edge_weights (
+                        run_id text,
+                        source integer,
+                        target integer,
+                        weight integer,
+                        first_seen integer,
+                        last_seen integer); """,
+
+    # Only written by runs with profile = True (see profiling.py)
+
+    "phase_times": """ CREATE TABLE IF NOT EXISTS phase_times (
+                        run_id text,
+                        phase text,
+                        calls integer,
+                        seconds real); """,
+
+    "step_metrics": """ CREATE TABLE IF NOT EXISTS step_metrics (
+                        run_id text,
+                        timestep integer,
+                        population integer,
+                        births integer,
+                        deaths integer,
+                        learn_events integer,
+                        social_edges integer,
+                        genetic_edges integer,
+                        seconds real); """,
+
+    # Only written by runs with network_metrics = True (see network_metrics.py)
+
+    "condition": """ CREATE TABLE IF NOT EXISTS condition (
+                        run_id text,
+                        U integer,
+                        C real,
+                        S real,
+                        A integer,
+                        H integer); """}
+
+
+# Columns added to the tables after the first databases were written. create_DB
+# adds them to an existing database that lacks them.
+
+DB_ADDED_COLUMNS = {"run_data": [("stop_policies", "text"),
+                                  ("event_driven", "integer"),
+                                  ("edge_mode", "text"),
+                                  ("grid", "text")]}
+
+
+def connect_db(db_file, timeout=60):
+    """opens a connection to the run database in write-ahead-log mode so that
+    readers are not blocked while runs are being written"""
+
+    conn = sqlite3.connect(db_file, timeout=timeout)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
-def add_run_data(conn, data):
 
-    try:
-        sql_run_dat = """ INSERT INTO run_data(run_id, datetime, n_time_steps, num_agents, num_sources, num_nutree, treessdie,
-            tool_acq, search_rad, tree_deaths)
+def create_DB(db_file):
+    """creates (if needed) the database where all of the ABM data will be stored
+    and returns a connection to it"""
 
-                              VALUES(?,?,?,?,?,?,?,?,?,?)
-            """
+    conn = connect_db(db_file)
 
-        conn.execute(sql_run_dat, data)
-        conn.commit()
+    with conn:
+        for table, sql in DB_TABLES.items():
+            conn.execute(sql)
+            if table != "run_data":
+                conn.execute("CREATE INDEX IF NOT EXISTS %s_run_id ON %s (run_id)" % (table, table))
 
+        for table, columns in DB_ADDED_COLUMNS.items():
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)}
+            for column, column_type in columns:
+                if column not in existing:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, column_type))
 
-    except sqlite3.Error as e:
-        print(e)
-        print("trying again")
+    return conn
 
 
-def add_source_data(conn, data, commit_now=True):
-    a = 0
+def delete_run(conn, run_id):
+    """removes every row stored for run_id, in every table"""
 
-    while a == 0:
-        try:
-            sql_run_dat = """ INSERT INTO sources(run_id, id, x, y, rm_quality)
+    for table in DB_TABLES:
+        conn.execute("DELETE FROM %s WHERE run_id = ?" % table, (run_id,))
 
-                              VALUES(?,?,?,?,?)
 
-            """
-            conn.execute(sql_run_dat, data)
-            if commit_now is True:
-                conn.commit()
-            else:
-                pass
-            a = 1
-
-        except sqlite3.Error as e:
-            print(e)
-            print("trying again")
+def insert_rows(conn, table, columns, rows):
 
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns), ", ".join("?" * len(columns)))
+    conn.executemany(sql, rows)
 
-def add_tree_data(conn, data, commit_now=True):
-    a = 0
 
-    while a == 0:
-        try:
-            sql_run_dat = """ INSERT INTO trees(run_id, id, x, y, ts_born, alive, ts_died, age)
+def add_run(conn, run_id, tables, retries=5):
+    """
+    :param conn: connection to the run database
+    :param run_id: the run the rows belong to
+    :param tables: dict mapping a table name to an iterable of (columns, rows) chunks holding the rows of one run
+    :param retries: the number of times a locked database is retried before giving up
+    :return: None. All of the rows of the run are written in a single transaction,
+    replacing any rows already stored for run_id (e.g. by a sweep that was resumed).
+    The chunks are inserted as they are read, so a run never has to be held in memory whole.
+    """
 
-                              VALUES(?,?,?,?,?,?,?,?)
+    # The chunks can only be read once, so the write lock is taken before the
+    # first of them is: once it is held the inserts cannot fail on a locked database.
+    for attempt in range(retries + 1):
 
-            """
-            conn.execute(sql_run_dat, data)
-            if commit_now is True:
-                conn.commit()
-            else:
-                pass
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            break
 
-            a = 1
+        except sqlite3.OperationalError as e:
 
-        except sqlite3.Error as e:
+            if attempt == retries:
+                raise
             print(e)
             print("trying again")
+            time.sleep(2 ** attempt)
+
+    with conn:
+        delete_run(conn, run_id)
+        for table, table_chunks in tables.items():
+            for columns, rows in table_chunks:
+                insert_rows(conn, table, columns, rows)
+
+
+def db_writer(db_file, queue):
+    """Writes the runs it receives from queue to db_file until it receives None.
+    Run in its own process so that the database has a single writer.
+
+    The workers send their runs in pieces, which can arrive interleaved with
+    those of other runs: ("start", run_id), then a ("rows", run_id, table,
+    columns, rows) message per chunk, with the run_data row last. The chunks
+    are held in temporary staging tables (on disk, not in memory) until the
+    run_data row arrives; the run then replaces any rows already stored for it
+    in a single transaction, as with add_run. A worker killed halfway leaves
+    staged rows only, which are dropped when the run starts again."""
+
+    conn = create_DB(db_file)
+    for table in DB_TABLES:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS staged_%s AS SELECT * FROM main.%s WHERE 0" % (table, table))
+        conn.execute("CREATE INDEX IF NOT EXISTS temp.staged_%s_run_id ON staged_%s (run_id)" % (table, table))
+
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+
+        kind, run_id = item[:2]
+        with conn:
+            if kind == "start":
+                for table in DB_TABLES:
+                    conn.execute("DELETE FROM temp.staged_%s WHERE run_id = ?" % table, (run_id,))
+
+            elif item[2] != "run_data":
+                insert_rows(conn, "temp.staged_" + item[2], *item[3:])
 
-def add_tool_data(conn, data, commit_now=True):
-    a = 0
-
-    while a == 0:
-        try:
-            sql_run_dat = """ INSERT INTO tools(
-                                run_id,
-                                id,
-                                parent_id,
-                                source_id,
-                                x,
-                                y,
-                                tool_size,
-                                original_size,
-                                active,
-                                rm_quality,
-                                ts_born,
-                                ts_died,
-                                n_uses)
-
-                              VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)
-
-            """
-            conn.execute(sql_run_dat, data)
-            if commit_now is True:
-                conn.commit()
             else:
-                pass
-            a = 1
+                delete_run(conn, run_id)
+                for table in DB_TABLES:
+                    if table != "run_data":
+                        conn.execute("INSERT INTO main.%s SELECT * FROM temp.staged_%s WHERE run_id = ?" % (table, table), (run_id,))
+                        conn.execute("DELETE FROM temp.staged_%s WHERE run_id = ?" % table, (run_id,))
+                insert_rows(conn, "run_data", *item[3:])
 
-        except sqlite3.Error as e:
-            print(e)
-            print("trying again")
+    conn.close()
 
-def add_env_data(conn, data, commit_now=True):
-    a = 0
 
-    while a == 0:
-        try:
-            sql_run_dat = """ INSERT INTO environment(
-                                run_id,
-                                trees_available,
-                                trees_near_sources,
-                                trees_near_pounding_tools)
-                              
-                              VALUES(?,?,?,?)
-            """
-            conn.execute(sql_run_dat, data)
-            if commit_now is True:
-                conn.commit()
-            else:
-                pass
-            a = 1
+def start_db_writer(db_file):
+    """starts a db_writer process and returns it with the queue that feeds it.
+    A SimpleQueue is used because its put() has written the run to the pipe
+    by the time it returns, so a worker that is shut down straight after
+    cannot leave a half-sent run behind."""
+
+    queue = multiprocessing.SimpleQueue()
+    process = multiprocessing.Process(target=db_writer, args=(db_file, queue), daemon=True)
+    process.start()
+    return process, queue
 
-        except sqlite3.Error as e:
-            print(e)
-            print("trying again")
 
+def stop_db_writer(process, queue):
+    """waits for the db_writer to write everything it has been sent"""
+
+    queue.put(None)
+    process.join()
 
 
 def select_table(conn, table):
 
+    if table not in DB_TABLES:
+        raise ValueError("Unknown table %r" % table)
+
     cursor = conn.cursor()
     sql = """ SELECT * FROM %s """ % table
     cursor.execute(sql)
     records = cursor.fetchall()
     return(records)
-
@@ -1,12 +1,40 @@
-import numpy.random
-import random
-from scipy.spatial import KDTree
-from mesa import Agent
-from pandas import DataFrame, concat
-from math import sqrt
-
-class Monkey(Agent):
-    """ The class of agent for the monkey model """
+from node_log import LEARNING_METHODS, METHOD_CODES, UNKNOWN
+
+# Encoding of learned_tool_use: False, True or "OG" for the tool users the run starts with.
+
+LEARNED_VALUES = (False, True, "OG")
+LEARNED_CODES = {False: 0, True: 1, "OG": 2}
+
+
+def encode_unknown(value):
+
+    """ Encodes an id or a True/False value that may be "Unknown" """
+
+    return UNKNOWN if value == "Unknown" else int(value)
+
+
+def decode_unknown(code, as_bool=False):
+
+    if code == UNKNOWN:
+        return "Unknown"
+    return code == 1 if as_bool else code
+
+
+class Monkey:
+    """ The class of agent for the monkey model. 
+
+    Monkeys are created and removed all the time, so the class is slotted
+    (no per-instance __dict__) and does not derive from mesa's Agent; the
+    schedule and the grid only need unique_id, pos and step(). The string
+    valued attributes are held as small integers (see node_log.py) and the
+    properties below present them the way they always were ("Naive",
+    "Unknown", "OG"), for visualization.py and anything else reading them. """
+
+    __slots__ = ("unique_id", "model", "pos",
+                 "tool_trait", "tool_user", "learned_code", "age", "age_learned_tool_use",
+                 "ts_learned_code", "method_code", "living", "tool_user_encounters",
+                 "prox_associations", "mother_id", "mother_user_code", "hairpattern",
+                 "nearest_attractor")
     
     # Aguements to be defined on instantiation.
     # self: inherited from the model
@@ -18,62 +46,74 @@ class Monkey(Agent):
 
     def __init__(self, unique_id, model, tool_user, mom, mom_user, hair):
 
-        super().__init__(unique_id,model)
+        self.unique_id = unique_id
+        self.model = model
+        self.pos = None # Set by the grid
         self.tool_trait = False # True / False indicating whether the individual has the tool use trait.
         self.tool_user = tool_user # see tool_user argument
-        self.learned_tool_use = False # True False statement indicating if the individual learned tool-use
+        self.learned_code = 0 # learned_tool_use: whether the individual learned tool-use (LEARNED_CODES)
         self.age = 0
         self.age_learned_tool_use = -1 
-        self.ts_learned = "Naive"
-        self.transmission_method = "Naive"
+        self.ts_learned_code = UNKNOWN # The time-step tool use was learned, UNKNOWN while "Naive"
+        self.method_code = 0 # transmission_method (node_log.METHOD_CODES), 0 is "Naive"
         self.living = True
         self.tool_user_encounters = 0
         self.prox_associations = 0
-        self.mother = mom
-        self.mother_tool_user = mom_user
+        self.mother_id = encode_unknown(mom) # UNKNOWN if the mother is "Unknown"
+        self.mother_user_code = encode_unknown(mom_user) # UNKNOWN, 0 (False) or 1 (True)
         self.hairpattern = hair
 
-## Helper Functions
+## Compatibility with the string valued attributes
 
-    def d2_mother(self, poss_steps, mom_loc):
+    @property
+    def learned_tool_use(self):
+        return LEARNED_VALUES[self.learned_code]
 
-        """Used by the move function determines the grid cell
-         that minimizes the distance between the agent and its
-         mother agent """
-        
-        # An empty vector to hold distances
+    @learned_tool_use.setter
+    def learned_tool_use(self, value):
+        self.learned_code = LEARNED_CODES[value]
 
-        pos_dists = [] 
+    @property
+    def ts_learned(self):
+        return "Naive" if self.ts_learned_code == UNKNOWN else self.ts_learned_code
 
-        # xy coordinates of mother location
+    @ts_learned.setter
+    def ts_learned(self, value):
+        self.ts_learned_code = UNKNOWN if value == "Naive" else value
 
-        x1, y1 = mom_loc 
+    @property
+    def transmission_method(self):
+        return LEARNING_METHODS[self.method_code]
 
-        # Determines the distance of each grid cell to the 
-        # location of the mother
+    @transmission_method.setter
+    def transmission_method(self, value):
+        self.method_code = METHOD_CODES[value]
 
-        for loc in poss_steps:
-            x2, y2 = loc
-            distance = sqrt(((x1 - x2) ** 2) + ((y1 - y2) ** 2))
-            pos_dists.append([distance])
+    @property
+    def mother(self):
+        return decode_unknown(self.mother_id)
 
-        # return the index value for the grid-cell that is nearest
-        #  the mother.
+    @mother.setter
+    def mother(self, value):
+        self.mother_id = encode_unknown(value)
+
+    @property
+    def mother_tool_user(self):
+        return decode_unknown(self.mother_user_code, as_bool=True)
+
+    @mother_tool_user.setter
+    def mother_tool_user(self, value):
+        self.mother_user_code = encode_unknown(value)
+
+## Helper Functions
 
-        return min(pos_dists), pos_dists.index(min(pos_dists))
-    
     def ClosestAttractor(self):
-        
-        
-        tree = KDTree(self.model.attractor_xy)
-        dist, idx = tree.query(self.pos)
-        pos_dists = DataFrame({"idx":[idx], "dist": [dist]})
-        closest = (pos_dists[(pos_dists["dist"] == min(pos_dists["dist"]))])
 
-        closest = int(closest.sample()['idx'])
-        closest = self.model.attractors[closest]
+        """ Looks up the location of the attractor nearest to the agent in the
+        table precomputed by the model """
 
-        self.nearest_attractor = closest.pos
+        x, y = self.pos
+        self.nearest_attractor = self.model.nearest_attractor_xy[x][y]
         
 ## Interaction Methods
 
@@ -88,23 +128,22 @@ class Monkey(Agent):
         # Identify all grid neighboring grids cells(i.e. grid cells that 
         # are a distance of 1 grid cell away from the agent)
 
-        possible_steps = self.model.grid.get_neighborhood(
-            self.pos,
-            moore=True,
-            include_center=False)
+        x, y = self.pos
+        possible_steps = self.model.grid.moore[x][y]
 
-        # Identify the location of the agent's mother. 
+        # Identify the agent's mother. The registry only holds living monkeys
+        # so None is returned if the mother is "Unknown" or has died.
 
-        mom_loc = [agent.pos for agent in self.model.schedule.agents if agent.unique_id == self.mother]
+        mom = self.model.monkeys.get(self.mother_id)
 
         # If the agent's mother is unknown then the choice is random. This only
         # applies at the start of the model run when the initial population of
         # individuals has no mothers or when the mother agent has died and has 
         # been removed from the model itself. 
 
-        if self.mother == "Unknown" or len(mom_loc) == 0:
+        if mom is None:
 
-            new_position = self.random.choice(possible_steps)
+            new_position = self.model.draws.choice(possible_steps)
             self.model.grid.move_agent(self, new_position)
 
         else:
@@ -112,9 +151,6 @@ class Monkey(Agent):
         # When the agent's mother is known then the grid cell the agent moves
         # into is determined by both age and the location of the mother.     
 
-             # Ranks the possible steps from closest to farthest from the mother.
-            d, idx = self.d2_mother(poss_steps= possible_steps, mom_loc=mom_loc[0])
-
             # determines the likelihood that the agent will move in a direction that 
             # minimizes the distance from the mother agent.  
             follow_prob = 1-((self.age*2)/100) 
@@ -130,59 +166,47 @@ class Monkey(Agent):
                 pass
             
             # Whether the agent moves in the direction of its mother detemined
-            #  by drawing from bimomial distribution where the probability of 
-            # success is set equal to the follow_prob. If the binomial distribution
-            # returns a 1 then the agent will move the direction of the mother's 
-            # location or else the choice is random.
+            #  by a Bernoulli draw where the probability of success is set equal
+            # to the follow_prob. If the draw is a success then the agent will 
+            # move the direction of the mother's location or else the choice is random.
 
-            if numpy.random.binomial(1, p= follow_prob) == 1:
+            if self.model.draws.uniform() < follow_prob:
 
-                # Move in the direction of the mother
+                # Move to the neighbouring grid cell nearest to the mother
 
-                new_position = possible_steps[idx]
+                new_position = self.model.grid.step_toward(self.pos, mom.pos, include_center=False)
 
             else:
 
                 # Choice is random
-                new_position = self.random.choice(possible_steps)
+                new_position = self.model.draws.choice(possible_steps)
 
             # Update the location of the agent
             self.model.grid.move_agent(self, new_position)
 
     def move_2(self):
         
-        possible_steps = self.model.grid.get_neighborhood(
-        self.pos,
-        moore=True,
-        include_center=True)
+        x, y = self.pos
+        possible_steps = self.model.grid.moore_center[x][y]
 
         if self.tool_user is False:
 
-            new_position = self.random.choice(possible_steps)
+            new_position = self.model.draws.choice(possible_steps)
             self.model.grid.move_agent(self, new_position)
 
         elif self.tool_user is True:
 
             self.ClosestAttractor()
 
-            pos_dists = [] # An empty vector to hold distances
-            x1, y1 = self.nearest_attractor # xy coordinates of mother location
-
-            for loc in possible_steps:
-                x2, y2 = loc
-                distance = sqrt(((x1 - x2) ** 2) + ((y1 - y2) ** 2))
-                pos_dists.append([distance])
-
-            d, idx = min(pos_dists), pos_dists.index(min(pos_dists))
-
-            prob = random.randint(1,100)
+            prob = self.model.draws.randint(1,100)
             
             if prob <= self.model.attractor_strength:
                 
-                new_position = possible_steps[idx]
+                # Move to the neighbouring grid cell nearest to the attractor
+                new_position = self.model.grid.step_toward(self.pos, self.nearest_attractor, include_center=True)
 
             else:
-                new_position = self.random.choice(possible_steps)
+                new_position = self.model.draws.choice(possible_steps)
 
             
             self.model.grid.move_agent(self, new_position)
@@ -194,30 +218,31 @@ class Monkey(Agent):
          then logs them as social interactions in the social_links dataframe"""
 
 
-        # Returns a list of all individuals that share the location of the agent
-
-        friends = self.model.grid.get_cell_list_contents(self.pos) 
-        friends = [friend for friend in friends if isinstance(friend, Monkey)]
-        # Makes sure the list does not contain the agent itself.
+        # The monkeys (the agent itself included) that occupy the agent's grid cell.
 
-        friends = [obj for obj in friends if obj.unique_id != self.unique_id] 
+        x, y = self.pos
+        cell = self.model.grid.monkeys_at[x][y]
+        n_friends = len(cell) - 1
 
         # If the agent has moved into a grid cell occupied by other agents, then 
-        # an intreraction event is logged for each of them. 
+        # an intreraction event is logged with one of them. 
 
-        if len(friends) > 0:
+        if n_friends > 0:
 
-            friend = random.choice(friends)
+            # Draws one of the other monkeys at random. Skipping over the agent's
+            # own slot picks the same monkey a random choice from the list of the
+            # others would.
+            k = int(self.model.draws.uniform() * n_friends)
+            if k >= cell.index(self):
+                k += 1
+            friend = cell[k]
 
             self.prox_associations += 1
 
             if friend.tool_user is True: 
                 self.tool_user_encounters += 1
 
-            link = DataFrame({"source":[friend.unique_id] , "target": [self.unique_id]})
-
-            #self.model.social_links = self.model.social_links.append(link)
-            self.model.social_links = concat([self.model.social_links, link])
+            self.model.social_links.append(friend.unique_id, self.unique_id, self.model.timestep)
 
             return friend
         else: 
@@ -245,7 +270,7 @@ class Monkey(Agent):
                 hair = 2 # Therefore, the inherited hair pattern will have a hairpattern of 2
 
             elif hair_score == 3: # One agent has a hair pattern of one and the other agent has pattern of 2
-                hair = random.randint(1,2) # hair pattern is then randomly chosen
+                hair = self.model.draws.randint(1,2) # hair pattern is then randomly chosen
 
             elif hair_score == 2: # Both agents have a hair pattern of 1
                 hair = 1 # inherited hair pattern is 1
@@ -254,7 +279,7 @@ class Monkey(Agent):
 
         # Creates a new individual. The hair variable is then passed to the offspring.
         
-            offspring = Monkey(unique_id=self.model.next_id(),
+            offspring = type(self)(unique_id=self.model.next_id(), # Same class as the mother (see profiling.py)
                             model=self.model,
                             tool_user=False,
                             mom=self.unique_id, # records the id of the mother
@@ -280,12 +305,15 @@ class Monkey(Agent):
         ## Agent is added to the grid space and schedule
             self.model.grid.place_agent(offspring, self.pos)
             self.model.schedule.add(offspring)
+            self.model.monkeys[offspring.unique_id] = offspring
+            self.model.n_living += 1
+            if self.model.event_driven is True:
+                self.model.schedule_events(offspring, self.model.timestep + 1) # The offspring first acts next time-step
+            if offspring.tool_trait is True:
+                self.model.n_trait_carriers += 1
 
         ## edges connecting the new individual to its "mother" are added.
-            link = DataFrame({"source": [self.unique_id], "target": [offspring.unique_id]})
-            
-            #self.model.ancestry_links = self.model.ancestry_links.append(link)
-            self.model.ancestry_links = concat([self.model.ancestry_links, link])
+            self.model.ancestry_links.append(self.unique_id, offspring.unique_id, self.model.timestep)
         else:
             
             pass
@@ -299,7 +327,13 @@ class Monkey(Agent):
         if self.age >= 25 and self.tool_user is False: 
             
             # Draws a random number between 0 and 100
-            x = random.uniform(0, 100) 
+            if self.model.asocial_events is True:
+                # Asocial learning is event driven (see hazards.py): the time-step of the
+                # monkey's learning event was drawn in advance. x is 0 at that time-step
+                # and beyond any learning rate otherwise.
+                x = 0 if self.unique_id in self.model.learning_now else float("inf")
+            else:
+                x = self.model.draws.uniform() * 100
             
             # The conditions for learning when the mode of transmission is social.
             if self.model.transmission_mode == "social": 
@@ -310,10 +344,11 @@ class Monkey(Agent):
                     if x < (self.tool_user_encounters * lr_multiplier):
                         
                         self.tool_user = True # updates the tool user status to True
+                        self.model.n_tool_users += 1
                         self.age_learned_tool_use = self.age # record the age at which tool use is expressed
-                        self.learned_tool_use = True # Makes sure the original tool-user at the beginning of the simulation
-                        self.ts_learned = self.model.timestep # Updates the time-step that this occurred during
-                        self.transmission_method = self.model.transmission_mode # record the transmission mode
+                        self.learned_code = 1 # Makes sure the original tool-user at the beginning of the simulation
+                        self.ts_learned_code = self.model.timestep # Updates the time-step that this occurred during
+                        self.method_code = METHOD_CODES[self.model.transmission_mode] # record the transmission mode
                     
                     else:pass
                 else:pass
@@ -324,10 +359,11 @@ class Monkey(Agent):
                     if x < 85 and self.tool_trait is True:
 
                         self.tool_user = True # updates the tool user status to True
+                        self.model.n_tool_users += 1
                         self.age_learned_tool_use = self.age # record the age at which tool use is expressed
-                        self.learned_tool_use = True # Makes sure the original tool-user at the beginning of the simulation
-                        self.ts_learned = self.model.timestep # Updates the time-step that this occurred during
-                        self.transmission_method = self.model.transmission_mode # record the transmission mode
+                        self.learned_code = 1 # Makes sure the original tool-user at the beginning of the simulation
+                        self.ts_learned_code = self.model.timestep # Updates the time-step that this occurred during
+                        self.method_code = METHOD_CODES[self.model.transmission_mode] # record the transmission mode
                     
                     else:
                         pass
@@ -335,13 +371,12 @@ class Monkey(Agent):
             # The conditions for learning when the mode of transmission is asocial.
             elif self.model.transmission_mode == "asocial" or self.model.transmission_mode == "resource_attraction":
 
-                x <- random.randint(1,100)
-
                 if x <= self.model.asocial_rate: 
                     self.tool_user = True
+                    self.model.n_tool_users += 1
                     self.age_learned_tool_use = self.age
-                    self.learned_tool_use = True
-                    self.ts_learned = self.model.timestep
+                    self.learned_code = 1
+                    self.ts_learned_code = self.model.timestep
 
             else: # For debugging
                 print("Warning! No transmission mode selected! Debug Model")
@@ -360,35 +395,30 @@ class Monkey(Agent):
 
         death_prob = .0001 + self.age/10000
 
-            # Detemines if the individual dies this timestep, drawn from a binomial distribution with the chances of success
+            # Detemines if the individual dies this timestep, a Bernoulli draw with the chances of success
             # dependent on the death_prob
 
-        die = numpy.random.binomial(1,death_prob, 1)
+        if self.model.event_driven is True:
+            # The age of death was drawn in advance (see hazards.py)
+            dies = self.unique_id in self.model.dying_now
+        else:
+            dies = self.model.draws.uniform() < death_prob
 
-        if die == 1: # If the individiaul dies.
+        if dies: # If the individiaul dies.
 
                 # Update living to false    
             self.living = False 
 
-                # All information recorded and exported
-            node_dat = {"id": self.unique_id,
-                            "run_id": self.model.run_id,
-                            "living": self.living,
-                            "tool_user": self.tool_user,
-                            "learned_tool_use": self.tool_user,
-                            "tool_user_encounters": self.tool_user_encounters,
-                            "age_learned_tool_use": self.age_learned_tool_use,
-                            "time_step_learned": self.ts_learned,
-                            "learning_method": self.transmission_method,
-                            "age": self.age,
-                            "mother": self.mother,
-                            "mother_tool_user": self.mother_tool_user,
-                            "hair": self.hairpattern}
-
-                # Appended to the nodes dataframe for export.
-            self.model.node_data.append(node_dat)
+                # All information recorded and exported (see node_log.py)
+            self.model.node_log.append(self)
             self.model.grid.remove_agent(self)
             self.model.schedule.remove(self)
+            del self.model.monkeys[self.unique_id]
+            self.model.n_living -= 1
+            if self.tool_user is True:
+                self.model.n_tool_users -= 1
+            if self.tool_trait is True:
+                self.model.n_trait_carriers -= 1
         else:
             pass
 
@@ -407,8 +437,7 @@ class Monkey(Agent):
         if mates is not None:
 
             #Repoduce
-            agents = [agent for agent in self.model.schedule.agents if isinstance(agent, Monkey)]
-            if len(agents) < self.model.Na:
+            if self.model.n_living < self.model.Na:
 
                 self.reproduce(mate=mates)
 
@@ -421,14 +450,3 @@ class Monkey(Agent):
 
         if self.model.transmission_mode == "inherited":
             self.grow()
-
-class ToolResource(Agent):
-
-    def __init__(self, unique_id, model):
-
-        super().__init__(unique_id,model)
-        self.tool_user = "Resource"
-
-    def step(self):
-        pass
-
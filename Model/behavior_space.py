@@ -1,11 +1,12 @@
 import os
 from model_definition import *
-from mesa.batchrunner import BatchRunnerMP
+from sweep import run_sweep
 from multiprocessing import freeze_support
 
 RUNS_PATH = "Model_2_Revisions"
 N_ITER = 750
 N_CORES = 65
+OUTPUT = "sqlite" # All runs go to RUNS_PATH/runs.sqlite. "csv" writes the per-run files read by Scripts/helper_functions.R
 
 
 if not os.path.isdir(RUNS_PATH):
@@ -17,7 +18,8 @@ fixed_params = {"width": 20,
                 "height":  20,
                 "Na": 100,
                 "runs_path": RUNS_PATH,
-                "N_Starting_Tool_users": 1
+                "N_Starting_Tool_users": 1,
+                "output": OUTPUT
                 }
 
 variable_params = {
@@ -27,14 +29,12 @@ variable_params = {
 if __name__ == '__main__':
     freeze_support()
 
-    mp_batch_run = BatchRunnerMP(model_cls=Mendelian_Monkeys,
-                             nr_processes= N_CORES,
-                             variable_parameters=variable_params,
-                             fixed_parameters=fixed_params,
-                             iterations=N_ITER,
-                             max_steps=1000000000)
-
-    mp_batch_run.run_all()
+    run_sweep(model_cls=Mendelian_Monkeys,
+              fixed_params=fixed_params,
+              variable_params=variable_params,
+              iterations=N_ITER,
+              max_steps=1000000000,
+              n_processes=N_CORES)
 
 
 ## Attraction null model
@@ -44,7 +44,8 @@ fixed_params = {"width": 20,
                 "Na": 100,
                 "runs_path": RUNS_PATH,
                 "N_Starting_Tool_users": 1,
-                "trans_mode": "resource_attraction"
+                "trans_mode": "resource_attraction",
+                "output": OUTPUT
                 }
 
 
@@ -60,11 +61,10 @@ variable_params = {
 if __name__ == '__main__':
     freeze_support()
 
-    mp_batch_run = BatchRunnerMP(model_cls=Mendelian_Monkeys,
-                             nr_processes= N_CORES,
-                             variable_parameters=variable_params,
-                             fixed_parameters=fixed_params,
-                             iterations=N_ITER,
-                             max_steps=1000000000)
+    run_sweep(model_cls=Mendelian_Monkeys,
+              fixed_params=fixed_params,
+              variable_params=variable_params,
+              iterations=N_ITER,
+              max_steps=1000000000,
+              n_processes=N_CORES)
 
-    mp_batch_run.run_all()
@@ -0,0 +1,166 @@
+from array import array
+from pandas import DataFrame
+import numpy
+
+# A (source, target) pair is stored as the single key source * PAIR_STRIDE + target.
+
+PAIR_STRIDE = 2**32
+
+
+class EdgeLog:
+    """ Append-only record of the edges (source, target, timestep) generated
+    during a model run. The edges are held in growable typed integer columns
+    so that recording an edge is amortized O(1) and the table is only built
+    once, when the model run ends."""
+
+    suffix = "edges" # Written as the <name>_edges table
+
+    def __init__(self):
+
+        self.source = array('q') # unique id of the agent the edge originates from
+        self.target = array('q') # unique id of the agent the edge points to
+        self.timestep = array('q') # time-step of the model during which the edge was created
+
+    def __len__(self):
+
+        return len(self.source)
+
+    def append(self, source, target, timestep):
+
+        """ Records a single edge """
+
+        self.source.append(source)
+        self.target.append(target)
+        self.timestep.append(timestep)
+
+    def extend(self, source, target, timestep):
+
+        """ Records a batch of edges. source and target are equal length arrays
+        of unique ids and timestep is a single time-step shared by the batch """
+
+        source = numpy.asarray(source, dtype=numpy.int64)
+        self.source.frombytes(source.tobytes())
+        self.target.frombytes(numpy.asarray(target, dtype=numpy.int64).tobytes())
+        self.timestep.frombytes(numpy.full(len(source), timestep, dtype=numpy.int64).tobytes())
+
+    def to_frame(self):
+
+        """ Returns the edges as a dataframe with the same layout as the
+        social_links and ancestry_links dataframes exported by earlier versions
+        of the model (float ids, every row indexed 0). The timestep column is
+        not part of that layout and is therefore not exported."""
+
+        n = len(self.source)
+
+        return DataFrame({"source": numpy.asarray(self.source, dtype=float),
+                          "target": numpy.asarray(self.target, dtype=float)},
+                         index=numpy.zeros(n, dtype=int))
+
+    def weighted(self):
+
+        """ Returns the distinct (source, target) pairs and the number of
+        edges recorded for each, ordered by source and target """
+
+        keys = numpy.asarray(self.source) * PAIR_STRIDE + numpy.asarray(self.target)
+        keys, weight = numpy.unique(keys, return_counts=True)
+        return keys // PAIR_STRIDE, keys % PAIR_STRIDE, weight
+
+
+class WeightedEdgeLog:
+    """ Record of the edges generated during a model run that keeps one entry
+    per distinct (source, target) pair: the number of edges between them and
+    the time-steps of the first and the last one. Takes the same calls as
+    EdgeLog. Edges are buffered as they come and folded into the pair counts,
+    held as sorted arrays, every chunk_size edges, so memory grows with the
+    number of pairs rather than with the number of edges. """
+
+    suffix = "edge_weights" # Written as the <name>_edge_weights table
+
+    def __init__(self, chunk_size=2**20):
+
+        self.chunk_size = chunk_size
+        self.n_edges = 0 # Number of edges recorded, including the ones still buffered.
+
+        self.keys = numpy.zeros(0, dtype=numpy.int64) # pair keys, sorted
+        self.weight = numpy.zeros(0, dtype=numpy.int64) # number of edges of each pair
+        self.first_seen = numpy.zeros(0, dtype=numpy.int64) # time-step of the first edge of each pair
+        self.last_seen = numpy.zeros(0, dtype=numpy.int64) # time-step of the last edge of each pair
+
+        self.pending = array('q') # keys of the edges not folded in yet
+        self.pending_timestep = array('q')
+
+    def __len__(self):
+
+        return self.n_edges
+
+    def append(self, source, target, timestep):
+
+        """ Records a single edge """
+
+        self.pending.append(source * PAIR_STRIDE + target)
+        self.pending_timestep.append(timestep)
+        self.n_edges += 1
+
+        if len(self.pending) >= self.chunk_size:
+            self.fold()
+
+    def extend(self, source, target, timestep):
+
+        """ Records a batch of edges. source and target are equal length arrays
+        of unique ids and timestep is a single time-step shared by the batch """
+
+        keys = numpy.asarray(source, dtype=numpy.int64) * PAIR_STRIDE + numpy.asarray(target, dtype=numpy.int64)
+        self.pending.frombytes(keys.tobytes())
+        self.pending_timestep.frombytes(numpy.full(len(keys), timestep, dtype=numpy.int64).tobytes())
+        self.n_edges += len(keys)
+
+        if len(self.pending) >= self.chunk_size:
+            self.fold()
+
+    def fold(self):
+
+        """ Adds the buffered edges to the pair counts """
+
+        keys = numpy.concatenate([self.keys, numpy.asarray(self.pending, dtype=numpy.int64)])
+        timestep = numpy.asarray(self.pending_timestep, dtype=numpy.int64)
+        weight = numpy.concatenate([self.weight, numpy.ones(len(timestep), dtype=numpy.int64)])
+        first_seen = numpy.concatenate([self.first_seen, timestep])
+        last_seen = numpy.concatenate([self.last_seen, timestep])
+
+        order = numpy.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]]) if len(keys) > 0 else numpy.zeros(0, dtype=numpy.int64)
+
+        self.keys = keys[starts]
+        if len(keys) > 0:
+            self.weight = numpy.add.reduceat(weight[order], starts)
+            self.first_seen = numpy.minimum.reduceat(first_seen[order], starts)
+            self.last_seen = numpy.maximum.reduceat(last_seen[order], starts)
+
+        self.pending = array('q')
+        self.pending_timestep = array('q')
+
+    def weighted(self):
+
+        """ As EdgeLog.weighted """
+
+        self.fold()
+        return self.keys // PAIR_STRIDE, self.keys % PAIR_STRIDE, self.weight
+
+    def to_frame(self):
+
+        """ Returns one row per distinct (source, target) pair with the number
+        of edges between them and the time-steps of the first and the last,
+        ordered by source and target """
+
+        self.fold()
+
+        return DataFrame({"source": self.keys // PAIR_STRIDE,
+                          "target": self.keys % PAIR_STRIDE,
+                          "weight": self.weight,
+                          "first_seen": self.first_seen,
+                          "last_seen": self.last_seen})
+
+
+EDGE_LOGS = {"raw": EdgeLog,
+             "weighted": WeightedEdgeLog}
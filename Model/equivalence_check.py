@@ -0,0 +1,166 @@
+""" Checks that Vectorized_Monkeys is statistically equivalent to the object
+model (Mendelian_Monkeys). Both models are run a number of times for each
+transmission mode and the distributions of the run length and of the number
+of social interactions per time-step are compared with two sample
+Kolmogorov-Smirnov tests. Exits with a non zero status if any of the tests
+rejects equivalence.
+
+    python equivalence_check.py [n_runs] [alpha] [--seed SEED]
+
+With --events it instead checks the event driven scheduling of hazards.py:
+the lifespans and asocial learning times it draws are compared with those of
+the per time-step draws, and the run lengths of both models are compared
+with and without event_driven.
+
+    python equivalence_check.py --events [n_runs] [alpha] [--seed SEED]
+
+Every run and every draw of the checks is seeded from SEED (default 1), so a
+given command always gives the same verdict and a regression fails every
+time rather than with probability alpha. With the defaults (40 runs, alpha =
+.01, seed 1) both checks pass.
+"""
+
+from model_definition import Mendelian_Monkeys
+from vectorized_model import Vectorized_Monkeys
+from hazards import death_age, learning_delay
+from scipy.stats import ks_2samp
+import numpy
+from contextlib import redirect_stdout
+import argparse
+import tempfile
+import sys
+import io
+
+MODES = {"social": {},
+         "inherited": {},
+         "asocial": {"learn_rate": 2},
+         "resource_attraction": {"N_Resources": 10, "attraction": 25, "learn_rate": 2}}
+
+MAX_STEPS = 5000
+SEED = 1
+
+
+def run_summary(model_cls, runs_path, trans_mode, seed, **params):
+
+    """ Runs a single model to completion and returns its run length and the
+    mean number of social interactions per time-step """
+
+    with redirect_stdout(io.StringIO()):
+        model = model_cls(height=20, width=20, Na=100, trans_mode=trans_mode, runs_path=runs_path, seed=seed, **params)
+        while model.running and model.timestep < MAX_STEPS:
+            model.step()
+
+    return model.timestep, len(model.social_links)/model.timestep
+
+
+def run_seeds(rng, n_runs):
+
+    """ Returns the seeds of n_runs runs, drawn from rng """
+
+    return rng.integers(2**53, size=n_runs).tolist()
+
+
+def compare(n_runs=40, alpha=.01, seed=SEED):
+
+    failed = []
+    rng = numpy.random.default_rng(seed)
+
+    with tempfile.TemporaryDirectory() as runs_path:
+        for trans_mode, params in MODES.items():
+
+            results = {}
+            for model_cls in (Mendelian_Monkeys, Vectorized_Monkeys):
+                runs = [run_summary(model_cls, runs_path, trans_mode, run_seed, **params) for run_seed in run_seeds(rng, n_runs)]
+                results[model_cls.__name__] = list(zip(*runs))
+
+            obj, vec = results["Mendelian_Monkeys"], results["Vectorized_Monkeys"]
+
+            for i, statistic in enumerate(("n_time_steps", "interactions_per_step")):
+                p = ks_2samp(obj[i], vec[i]).pvalue
+                print("%-20s %-22s object mean %10.2f  vectorized mean %10.2f  p = %.3f" %
+                      (trans_mode, statistic, sum(obj[i])/n_runs, sum(vec[i])/n_runs, p))
+                if p < alpha:
+                    failed.append((trans_mode, statistic))
+
+    return failed
+
+
+def per_step_lifespans(age, rng):
+
+    """ Returns the age at death of monkeys now aged age, drawn as Monkey.grow
+    does: a Bernoulli draw every time-step """
+
+    age = age.copy()
+    dead_at = numpy.zeros(len(age), dtype=numpy.int64)
+    alive = numpy.ones(len(age), dtype=bool)
+    while alive.any():
+        age[alive] += 1
+        dies = alive & (rng.random(len(age)) < .0001 + age/10000)
+        dead_at[dies] = age[dies]
+        alive &= ~dies
+    return dead_at
+
+
+def per_step_delays(learn_rate, n, rng):
+
+    """ Returns the time-step (1 for the first one) at which each of n eligible
+    monkeys learns asocially, drawn as Monkey.learn does """
+
+    delay = numpy.zeros(n, dtype=numpy.int64)
+    step = 0
+    while (delay == 0).any():
+        step += 1
+        learns = (delay == 0) & (rng.random(n) * 100 <= learn_rate)
+        delay[learns] = step
+    return delay
+
+
+def compare_events(n_runs=40, alpha=.01, n_monkeys=20000, seed=SEED):
+
+    failed = []
+    rng = numpy.random.default_rng(seed)
+
+    def check(label, a, b):
+        p = ks_2samp(a, b).pvalue
+        print("%-50s per step mean %10.2f  event driven mean %10.2f  p = %.3f" % (label, numpy.mean(a), numpy.mean(b), p))
+        if p < alpha:
+            failed.append(label)
+
+    # Lifespans of newborns and of monkeys of the ages the initial population is given.
+    for label, age in (("lifespan (newborn)", numpy.zeros(n_monkeys, dtype=numpy.int64)),
+                       ("lifespan (aged 0 to 100)", rng.integers(0, 101, size=n_monkeys))):
+        check(label, per_step_lifespans(age, rng), death_age(age, rng.random(n_monkeys)))
+
+    for learn_rate in (1, 2, 5, 50):
+        check("asocial learning time (learn_rate = %s)" % learn_rate,
+              per_step_delays(learn_rate, n_monkeys, rng), learning_delay(learn_rate/100, rng.random(n_monkeys)))
+
+    with tempfile.TemporaryDirectory() as runs_path:
+        for trans_mode in ("inherited", "asocial", "resource_attraction"):
+            for model_cls in (Mendelian_Monkeys, Vectorized_Monkeys):
+                lengths = [[run_summary(model_cls, runs_path, trans_mode, run_seed, event_driven=event_driven, **MODES[trans_mode])[0]
+                            for run_seed in run_seeds(rng, n_runs)] for event_driven in (False, True)]
+                check("%s %s n_time_steps" % (model_cls.__name__, trans_mode), *lengths)
+
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compares the engines, or the event driven scheduling, statistically")
+    parser.add_argument("n_runs", nargs="?", type=int, default=40)
+    parser.add_argument("alpha", nargs="?", type=float, default=.01)
+    parser.add_argument("--events", action="store_true", help="check the event driven scheduling of hazards.py")
+    parser.add_argument("--seed", type=int, default=SEED, help="seed of every run and draw of the check")
+    args = parser.parse_args()
+
+    if args.events:
+        failed = compare_events(args.n_runs, args.alpha, seed=args.seed)
+    else:
+        failed = compare(args.n_runs, args.alpha, seed=args.seed)
+
+    if len(failed) > 0:
+        print("Not equivalent: %s" % failed)
+        sys.exit(1)
+    else:
+        print("All statistics equivalent at alpha = %s (seed %s)" % (args.alpha, args.seed))
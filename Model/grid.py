@@ -0,0 +1,288 @@
+from mesa.space import MultiGrid
+from agents import Monkey
+
+# Grids of more cells than this are sparse when Mendelian_Monkeys is given grid = "auto".
+
+SPARSE_CELLS = 250000
+
+
+class MooreSteps:
+
+    """ The Moore neighbourhoods and the step toward a target shared by
+    MonkeyGrid and SparseMonkeyGrid """
+
+    def neighbours(self, x, y, include_center):
+
+        return tuple((x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                     if (include_center or dx != 0 or dy != 0) and
+                     0 <= x + dx < self.width and 0 <= y + dy < self.height)
+
+    def step_toward(self, pos, target, include_center):
+
+        """ Returns the cell of the Moore neighbourhood of pos that is nearest to
+        target, as the first minimum of the euclidean distances over the
+        neighbourhood in get_neighborhood order would. Moving one cell along
+        the sign of each axis is always the unique nearest cell, unless the
+        target is pos itself. """
+
+        x, y = pos
+        tx, ty = target
+
+        if tx == x and ty == y:
+            return pos if include_center else self.nearest_to_self[x][y]
+
+        return (x + (tx > x) - (tx < x), y + (ty > y) - (ty < y))
+
+    def first_orthogonal(self, x, y):
+
+        """ The neighbour nearest to the cell itself: the first orthogonal neighbour """
+
+        return next(((nx, ny) for nx, ny in self.moore[x][y] if abs(nx - x) + abs(ny - y) == 1), None)
+
+
+class MonkeyGrid(MooreSteps, MultiGrid):
+    """ MultiGrid that also keeps a monkeys only occupancy index. monkeys_at[x][y]
+    lists the monkeys in cell (x, y), in the order the cell itself holds them,
+    and is updated whenever an agent is placed, moved or removed. Looking up
+    the monkeys an agent shares its cell with therefore needs no filtering or
+    list building (see Monkey.social_interaction). """
+
+    sparse = False
+
+    def __init__(self, width, height, torus):
+
+        super().__init__(width, height, torus)
+        self.monkeys_at = [[[] for y in range(height)] for x in range(width)]
+
+        # The grid never changes, so the Moore neighbourhood of every cell, without
+        # and with the cell itself, is listed once, in the order get_neighborhood
+        # returns it.
+        self.moore = [[self.neighbours(x, y, False) for y in range(height)] for x in range(width)]
+        self.moore_center = [[self.neighbours(x, y, True) for y in range(height)] for x in range(width)]
+
+        # The neighbour nearest to the cell itself: the first orthogonal neighbour.
+        self.nearest_to_self = [[self.first_orthogonal(x, y) for y in range(height)] for x in range(width)]
+
+    def _place_agent(self, pos, agent):
+
+        super()._place_agent(pos, agent)
+        if isinstance(agent, Monkey):
+            x, y = pos
+            self.monkeys_at[x][y].append(agent)
+
+    def _remove_agent(self, pos, agent):
+
+        super()._remove_agent(pos, agent)
+        if isinstance(agent, Monkey):
+            x, y = pos
+            self.monkeys_at[x][y].remove(agent)
+
+
+def no_agents(x, y):
+
+    return []
+
+
+class LazyColumns(dict):
+
+    """ A table read as table[x][y], like the nested lists of MonkeyGrid, that
+    only stores the cells it is given. Reading any other cell returns
+    default(x, y), which is stored too if store is True (a cache). Columns are
+    created on first use. """
+
+    def __init__(self, default, store=False):
+
+        self.default = default
+        self.store = store
+
+    def __missing__(self, x):
+
+        column = self[x] = LazyColumn(x, self.default, self.store)
+        return column
+
+
+class LazyColumn(dict):
+
+    def __init__(self, x, default, store=False):
+
+        self.x = x
+        self.default = default
+        self.store = store
+
+    def __missing__(self, y):
+
+        value = self.default(self.x, y)
+        if self.store is True:
+            self[y] = value
+        return value
+
+
+class SparseMonkeyGrid(MooreSteps):
+
+    """ Multi agent grid for very large landscapes. mesa's MultiGrid and
+    MonkeyGrid allocate every cell up front (the cell lists, the set of empty
+    cells and the tables of neighbourhoods), which rules out landscapes of a
+    million cells or more. This grid only stores the occupied cells, in dicts
+    keyed by x and then y, and works the neighbourhood of a cell out when it
+    is asked for, so its memory use follows the population and not the area.
+
+    It has MonkeyGrid's interface (monkeys_at, moore, moore_center and
+    step_toward, read as [x][y] tables) and the parts of MultiGrid's the model
+    and the visualization use: place_agent, move_agent, remove_agent,
+    get_cell_list_contents, is_cell_empty, get_neighborhood and
+    get_neighbors. Agents are listed in the order they arrived in their cell,
+    as in MultiGrid, so a run draws the same random numbers on either grid. """
+
+    sparse = True
+
+    def __init__(self, width, height, torus):
+
+        self.width = width
+        self.height = height
+        self.torus = torus
+
+        self.cells = LazyColumns(no_agents) # The agents in each occupied cell.
+        self.monkeys_at = LazyColumns(no_agents) # The monkeys in each occupied cell.
+
+        self.moore = LazyColumns(self.moore_of)
+        self.moore_center = LazyColumns(self.moore_center_of)
+        self.nearest_to_self = LazyColumns(self.first_orthogonal)
+
+    def moore_of(self, x, y):
+
+        return self.neighbours(x, y, False)
+
+    def moore_center_of(self, x, y):
+
+        return self.neighbours(x, y, True)
+
+## Occupancy
+
+    def place_agent(self, agent, pos):
+
+        """ Positions an agent on the grid and sets its pos """
+
+        self._place_agent(pos, agent)
+        agent.pos = pos
+
+    def move_agent(self, agent, pos):
+
+        """ Moves an agent from its current position to pos """
+
+        pos = self.torus_adj(pos)
+        self._remove_agent(agent.pos, agent)
+        self._place_agent(pos, agent)
+        agent.pos = pos
+
+    def remove_agent(self, agent):
+
+        """ Removes an agent from the grid and sets its pos to None """
+
+        self._remove_agent(agent.pos, agent)
+        agent.pos = None
+
+    def _place_agent(self, pos, agent):
+
+        x, y = pos
+        cell = self.cells[x].setdefault(y, [])
+        if agent not in cell:
+            cell.append(agent)
+        if isinstance(agent, Monkey):
+            self.monkeys_at[x].setdefault(y, []).append(agent)
+
+    def _remove_agent(self, pos, agent):
+
+        # Cells are dropped as soon as they are empty.
+        x, y = pos
+        for table in (self.cells, self.monkeys_at) if isinstance(agent, Monkey) else (self.cells,):
+            column = table[x]
+            column[y].remove(agent)
+            if len(column[y]) == 0:
+                del column[y]
+
+    def is_cell_empty(self, pos):
+
+        x, y = pos
+        return y not in self.cells[x]
+
+    def get_cell_list_contents(self, cell_list):
+
+        """ Returns the agents in the cells of cell_list (a list of (x, y), or
+        a single (x, y)) """
+
+        if len(cell_list) == 2 and type(cell_list[0]) == int: # A single cell, as mesa's accept_tuple_argument
+            cell_list = [cell_list]
+        return [agent for x, y in cell_list for agent in self.cells[x][y]]
+
+    def iter_cell_list_contents(self, cell_list):
+
+        return iter(self.get_cell_list_contents(cell_list))
+
+## Neighbourhoods
+
+    def out_of_bounds(self, pos):
+
+        x, y = pos
+        return x < 0 or x >= self.width or y < 0 or y >= self.height
+
+    def torus_adj(self, pos):
+
+        if not self.out_of_bounds(pos):
+            return pos
+        elif not self.torus:
+            raise Exception("Point out of bounds, and space non-toroidal.")
+        else:
+            return pos[0] % self.width, pos[1] % self.height
+
+    def get_neighborhood(self, pos, moore, include_center=False, radius=1):
+
+        """ As MultiGrid.get_neighborhood: the sorted cells within radius of
+        pos (Moore or von Neumann neighbourhood). Not cached. """
+
+        coordinates = set()
+        x, y = pos
+        for dy in range(-radius, radius + 1):
+            for dx in range(-radius, radius + 1):
+                if dx == 0 and dy == 0 and not include_center:
+                    continue
+                if not moore and abs(dx) + abs(dy) > radius:
+                    continue
+                coord = (x + dx, y + dy)
+                if self.out_of_bounds(coord):
+                    if not self.torus:
+                        continue
+                    coord = self.torus_adj(coord)
+                coordinates.add(coord)
+
+        return sorted(coordinates)
+
+    def get_neighbors(self, pos, moore, include_center=False, radius=1):
+
+        return self.get_cell_list_contents(self.get_neighborhood(pos, moore, include_center, radius))
+
+    def iter_neighbors(self, pos, moore, include_center=False, radius=1):
+
+        return iter(self.get_neighbors(pos, moore, include_center, radius))
+
+
+GRIDS = {"dense": MonkeyGrid,
+         "sparse": SparseMonkeyGrid}
+
+
+def grid_kind(grid, width, height):
+
+    """ Returns the name of the grid make_grid builds for grid ("dense",
+    "sparse" or "auto": sparse for more than SPARSE_CELLS cells) """
+
+    if grid == "auto":
+        grid = "sparse" if width * height > SPARSE_CELLS else "dense"
+    if grid not in GRIDS:
+        raise ValueError("Unknown grid %r, expected one of %s" % (grid, sorted(GRIDS) + ["auto"]))
+    return grid
+
+
+def make_grid(grid, width, height, torus):
+
+    """ Returns the grid named grid (see grid_kind) """
+
+    return GRIDS[grid_kind(grid, width, height)](width=width, height=height, torus=torus)
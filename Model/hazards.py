@@ -0,0 +1,112 @@
+""" Event driven scheduling of the deaths and of asocial learning.
+
+By default both are Bernoulli draws made every time-step for every monkey at
+risk: in the inherited mode a monkey that has just turned a dies with
+probability .0001 + a/10000 (Monkey.grow), and in the asocial and
+resource_attraction modes a naive monkey of 25 or older learns with
+probability learn_rate/100 (Monkey.learn). Almost all of these draws fail.
+
+With event_driven = True the models draw the outcome of the whole sequence of
+trials at once instead, when a monkey is born (or is set up at the start of
+the run): the age it will die at, by inverting its survival function, and
+the number of time-steps until it learns, a geometric draw. The time-steps of
+these events are kept in an EventQueue and every time-step only the monkeys
+whose event is due are touched. Lifespans and learning times have exactly the
+distribution of the per time-step draws (equivalence_check.py --events
+compares the two); the random numbers drawn, and so the runs of a given seed,
+differ.
+
+Ages only advance in the inherited mode, so a monkey of the asocial modes is
+either old enough to learn when it is created or never is.
+"""
+
+from bisect import bisect_left
+import heapq
+import math
+import numpy
+
+ASOCIAL_MODES = ("asocial", "resource_attraction")
+
+
+def death_hazard(age):
+
+    """ The probability of dying in the time-step in which a monkey turns age """
+
+    return numpy.minimum(1, .0001 + age/10000)
+
+
+# CUMULATIVE_HAZARD[a] = -log of the probability of surviving from birth to age
+# a (included). It is infinite from the first age at which death is certain.
+
+with numpy.errstate(divide="ignore"):
+    CUMULATIVE_HAZARD = numpy.cumsum(-numpy.log1p(-death_hazard(numpy.arange(10002)) * (numpy.arange(10002) > 0)))
+CUMULATIVE_HAZARD_LIST = CUMULATIVE_HAZARD.tolist() # For lookups one monkey at a time (bisect).
+
+
+def death_age(age, u):
+
+    """ Returns the age a monkey now aged age will die at, given a uniform draw
+    u in [0, 1): the first age at which the probability of still being alive
+    drops to 1 - u or below. age and u are numbers or arrays. """
+
+    threshold = CUMULATIVE_HAZARD[age] - numpy.log1p(-u)
+    return numpy.maximum(numpy.searchsorted(CUMULATIVE_HAZARD, threshold), age + 1)
+
+
+def death_age_one(age, u):
+
+    """ death_age for a single monkey, without numpy """
+
+    threshold = CUMULATIVE_HAZARD_LIST[age] - math.log1p(-u)
+    return max(bisect_left(CUMULATIVE_HAZARD_LIST, threshold), age + 1)
+
+
+def learning_delay(p, u):
+
+    """ Returns the number of time-steps (1 for the first one) until the first
+    success of a Bernoulli trial with probability p made every time-step,
+    given a uniform draw u in [0, 1), or None if p is 0. u can be an array. """
+
+    if p <= 0:
+        return None
+    if p >= 1:
+        return numpy.ones(numpy.shape(u), dtype=numpy.int64) if numpy.ndim(u) > 0 else 1
+
+    if numpy.ndim(u) > 0:
+        return numpy.floor(numpy.log1p(-u) / math.log1p(-p)).astype(numpy.int64) + 1
+    return math.floor(math.log1p(-u) / math.log1p(-p)) + 1
+
+
+class EventQueue:
+
+    """ The time-steps of the upcoming events of one kind (e.g. deaths), a heap
+    of (time-step, unique_id) pairs """
+
+    def __init__(self):
+
+        self.heap = []
+
+    def __len__(self):
+
+        return len(self.heap)
+
+    def push(self, step, unique_id):
+
+        heapq.heappush(self.heap, (step, unique_id))
+
+    def extend(self, steps, ids):
+
+        """ Adds an event for each of ids, at the matching entry of steps """
+
+        for event in zip(numpy.asarray(steps).tolist(), numpy.asarray(ids).tolist()):
+            heapq.heappush(self.heap, event)
+
+    def pop(self, step):
+
+        """ Removes and returns the unique ids of the events due at (or, if any
+        were missed, before) time-step step """
+
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] <= step:
+            due.append(heapq.heappop(self.heap)[1])
+        return due
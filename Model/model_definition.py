@@ -1,34 +1,71 @@
-from agents import Monkey, ToolResource
+from agents import Monkey
 from mesa import Model
 from mesa.time import RandomActivation
-from mesa.space import MultiGrid
-from abm_functions import get_random_alphanumeric_string
+from abm_functions import make_run_id, nearest_attractor_table, nearest_attractor, UniformStream, new_seed
+from edge_log import EdgeLog, EDGE_LOGS
+from node_log import NodeLog
+from grid import make_grid, grid_kind, LazyColumns
+from output import get_backend
+from network_metrics import logged_condition_table
+from stop_policies import make_policies, check_policies
+from hazards import EventQueue, ASOCIAL_MODES, death_age_one, learning_delay
+from profiling import StepProfiler, ProfiledMonkey, ProfiledActivation
 from datetime import datetime
 import pandas as pd
+import json
+import numpy
 import random
+import pickle
+import inspect
 import os
 
 def compute_n_users(model):
 
-    agents = [agent for agent in model.schedule.agents if isinstance(agent, Monkey)]
-    agents = [agent.tool_user for agent in agents if agent.tool_user is True]
+    agents = [agent.tool_user for agent in model.schedule.agents if agent.tool_user is True]
     return len(agents)
 
 def compute_n_w_trait(model):
 
-    agents = [agent for agent in model.schedule.agents if isinstance(agent, Monkey)]
-    agents = [agent.tool_user for agent in agents if agent.tool_trait is True]
+    agents = [agent.tool_user for agent in model.schedule.agents if agent.tool_trait is True]
     return len(agents)
 
+def check_counters(model):
+
+    """ Recounts the living monkeys, tool users and trait carriers from the
+    schedule and compares them with the counters maintained by the model.
+    Only called when the model is run in debug mode. """
+
+    recount = {"n_living": model.schedule.get_agent_count(),
+               "n_tool_users": compute_n_users(model),
+               "n_trait_carriers": compute_n_w_trait(model)}
+
+    for counter, value in recount.items():
+        if getattr(model, counter) != value:
+            raise RuntimeError("%s is %s but a full recount gives %s (time-step %s)" % 
+                               (counter, getattr(model, counter), value, model.timestep))
+
 class Mendelian_Monkeys(Model):
 
     def __init__(self,
                  height, width, Na, N_Starting_Tool_users = 1, 
                  N_Resources = 0, attraction = 5, learn_rate = 1,
-                 trans_mode = "social", runs_path = "Test"):
+                 trans_mode = "social", runs_path = "Test", debug = False, seed = None,
+                 output = "csv", snapshot_every = 0, profile = False, stop_policies = None,
+                 network_metrics = False, write_edges = True, edge_mode = "raw", event_driven = False,
+                 grid = "auto"):
         self.runs_path = runs_path
-        self.run_id = get_random_alphanumeric_string(6)
-        #self.run_id = "debug" # For debugging puposes only
+        self.snapshot_every = snapshot_every # A snapshot of the run is saved every snapshot_every time-steps (0 = never). See save_snapshot.
+
+        # Every random draw of a run comes from generators seeded with the run's seed, so
+        # a run can be replayed from the seed recorded in its run data (see replay.py).
+        # mesa stores its random.Random on the class; an instance attribute keeps the
+        # stream private to this model.
+        if seed is None:
+            seed = new_seed()
+        self.seed = seed
+        self.random = random.Random(seed) # Used to set up the model and to shuffle the schedule.
+        self.draws = UniformStream(seed) # Uniform random numbers used by the agents. Drawn in blocks and handed out one at a time.
+
         self.datetime = datetime.now()
         self.max_ts = 50000 # For debugging only
         self.starting_users = N_Starting_Tool_users # The number of individuals that begin with the tool use trait. 
@@ -41,6 +78,22 @@ class Mendelian_Monkeys(Model):
         self.asocial_rate = learn_rate
         self.attractor_strength = attraction
         self.transmission_mode = trans_mode # how the tool use trait is transmitted from one individual to the other. 
+        self.debug = debug # When True the population counters are checked against a full recount every time-step.
+        self.network_metrics = network_metrics # When True the social network measures of the run are written as its condition table (see network_metrics.py).
+        self.write_edges = write_edges # When False the social and genetic edge tables are not written.
+        # When True deaths and asocial learning are drawn in advance, once per monkey, and kept
+        # in event queues instead of being drawn every time-step (see hazards.py).
+        self.event_driven = event_driven
+        self.asocial_events = event_driven is True and trans_mode in ASOCIAL_MODES
+        self.deaths_due = EventQueue() # Time-steps of the deaths to come (inherited mode).
+        self.learning_due = EventQueue() # Time-steps of the asocial learning events to come.
+        self.dying_now = set() # The unique ids of the monkeys whose event is due this time-step.
+        self.learning_now = set()
+        self.n_living = 0 # The number of living monkeys. Updated on birth and death.
+        self.n_tool_users = 0 # The number of living tool users. Updated on learning, birth and death.
+        self.n_trait_carriers = 0 # The number of living monkeys carrying the tool use trait. Updated on birth and death.
+        self.profiler = StepProfiler() if profile else None # Times the phases of every step when profile is True (see profiling.py).
+        monkey_cls = ProfiledMonkey if profile else Monkey
 
         #### Debuging
         # print(self.asocial_rate)
@@ -49,30 +102,49 @@ class Mendelian_Monkeys(Model):
 
         ### Space, Scheduling
 
-        self.schedule = RandomActivation(self) # The order that the agents are iterated through during each time-step. 
+        self.schedule = (ProfiledActivation if profile else RandomActivation)(self) # The order that the agents are iterated through during each time-step. 
 
-        self.grid = MultiGrid(width=width, # Grid type. This particular grid allows multiple agents to occupy a space. 
+        # Grid type. Both grids allow multiple agents to occupy a space and index the monkeys in each cell.
+        # The "sparse" grid only stores the occupied cells, for very large landscapes; "auto" uses it
+        # above grid.SPARSE_CELLS cells (see grid.py).
+        self.grid = make_grid(grid,
+                              width=width,
                               height=height, 
                               torus= False)
-        self.node_data = []
-        self.social_links = pd.DataFrame({'source': [], 'target': []} ) # Creates a dataframe where information on each interaction is held. Used to generate the social networks. 
-        self.ancestry_links = pd.DataFrame({'source': [], 'target': []}) # Creates a dataframe where information on each repoductive event is held. Not used in the paper. 
+        # The run_id follows from the seed and the settings recorded in the run data, so runs
+        # that reuse a seed with other settings do not overwrite each other's output.
+        self.run_id = self.run_id_for(seed, height=height, width=width, Na=Na, N_Starting_Tool_users=N_Starting_Tool_users,
+                                      N_Resources=N_Resources, attraction=attraction, learn_rate=learn_rate,
+                                      trans_mode=trans_mode, stop_policies=stop_policies, event_driven=event_driven,
+                                      edge_mode=edge_mode, grid=grid)
+        #self.run_id = "debug" # For debugging puposes only
+        self.node_log = NodeLog(self.runs_path, self.run_id) # Node records of the dead monkeys, and of the survivors once the run ends.
+        self.monkeys = {} # Registry of the living monkeys keyed by unique_id. Used to look up an agent's mother. 
+        # Holds information on each interaction. Used to generate the social networks. Either every
+        # interaction (edge_mode = "raw") or their number per pair of monkeys ("weighted"), see edge_log.py.
+        if edge_mode not in EDGE_LOGS:
+            raise ValueError("Unknown edge_mode %r, expected one of %s" % (edge_mode, sorted(EDGE_LOGS)))
+        self.social_links = EDGE_LOGS[edge_mode]()
+        self.edge_mode = edge_mode
+        self.ancestry_links = EdgeLog() # Holds information on each repoductive event. Not used in the paper. 
 
         ## create agents
 
         for i in range(Na-N_Starting_Tool_users):
-            hair = random.choice([1,2])
-            agent = Monkey(self.next_id(), self, tool_user= False,mom="Unknown", mom_user= "Unknown", hair=hair)
-            agent.age = random.randint(0,100) # stops mass die off events
+            hair = self.random.choice([1,2])
+            agent = monkey_cls(self.next_id(), self, tool_user= False,mom="Unknown", mom_user= "Unknown", hair=hair)
+            agent.age = self.random.randint(0,100) # stops mass die off events
             x = self.random.randrange(self.grid.width)
             y = self.random.randrange(self.grid.height)
             self.grid.place_agent(agent,(x,y))
             self.schedule.add(agent)
+            self.monkeys[agent.unique_id] = agent
+            self.n_living += 1
 
     
         for i in range(Na-(Na-N_Starting_Tool_users)):
             hair = 2
-            agent = Monkey(self.next_id(), self, tool_user=True , mom="Unknown", mom_user="Unknown", hair=hair)
+            agent = monkey_cls(self.next_id(), self, tool_user=True , mom="Unknown", mom_user="Unknown", hair=hair)
             x = int(width/2)
             y = int(height/2)
             agent.learned_tool_use = "OG"
@@ -80,29 +152,36 @@ class Mendelian_Monkeys(Model):
             agent.tool_trait = True
             self.grid.place_agent(agent,(x,y))
             self.schedule.add(agent)
+            self.monkeys[agent.unique_id] = agent
+            self.n_living += 1
+            self.n_tool_users += 1
+            self.n_trait_carriers += 1
 
         
         if self.transmission_mode == "resource_attraction":
 
-            coord_list = []
-
-            for i in range(width):
-                x = i
-                for j in range(height):
-                    y=j 
-                    coord_list.append((x,y))
-
-    
-            coord_list = random.sample(coord_list, self.Nr)
-
-            for coords in coord_list:
-  
-                agent = ToolResource(self.next_id(), self)
-                self.grid.place_agent(agent,coords)
-                self.schedule.add(agent)
-
-                self.attractors = [obj for obj in self.schedule.agents if isinstance(obj, ToolResource)]
-                self.attractor_xy = [agent.pos for agent in self.attractors]
+            # The attractors never move or act, so they are not agents: they are a static
+            # layer of the environment, kept out of the grid and the schedule, made of
+            # their positions and the nearest attractor of every grid cell.
+            # The cells are sampled by their index in the list of all of the (x, y)
+            # coordinates, x by x, without building the list; random.sample picks the
+            # same cells from the range of indices as it would from the list itself.
+            self.attractor_xy = [divmod(cell, height) for cell in self.random.sample(range(width * height), self.Nr)]
+
+            # The nearest attractor to every grid cell is looked up once.
+            # Monkey.ClosestAttractor then only has to index this table.
+            if self.grid.sparse is True:
+                # No table: the nearest attractor of a cell is found the first
+                # time a monkey stands on it and kept for later visits.
+                self.attractor_x, self.attractor_y = numpy.array(self.attractor_xy).reshape(-1, 2).T
+                self.nearest_attractor_xy = LazyColumns(self.nearest_attractor_of, store=True)
+            else:
+                table = nearest_attractor_table(width, height, self.attractor_xy, rng=self.draws.generator)
+                self.nearest_attractor_xy = [[self.attractor_xy[idx] for idx in column] for column in table.tolist()]
+
+        if self.event_driven is True:
+            for agent in self.schedule.agents:
+                self.schedule_events(agent, 0)
             
         # write run Summary...
 
@@ -112,10 +191,103 @@ class Mendelian_Monkeys(Model):
         else:
             pass
 
+        self.output = get_backend(output, self.runs_path) # Where the tables of the run are written when it ends (see output.py).
+
+        # Extra stopping rules for runs that drift without reaching a conclusion (see stop_policies.py).
+        self.stop_policy_spec = stop_policies or {} # Recorded in the run data, so that replays stop the same way.
+        self.stop_policies = make_policies(stop_policies)
+        for policy in self.stop_policies:
+            policy.start(self)
+
+    @classmethod
+    def run_id_for(cls, seed, **params):
+
+        """ Returns the run_id of cls(seed = seed, **params) without building the model """
+
+        args = inspect.signature(cls).bind(seed=seed, **params)
+        args.apply_defaults()
+        params = args.arguments
+
+        return make_run_id(seed, {"engine": cls.__name__, "height": params["height"], "width": params["width"],
+                                  "Na": params["Na"], "N_Starting_Tool_users": params["N_Starting_Tool_users"],
+                                  "N_Resources": params["N_Resources"], "attraction": params["attraction"],
+                                  "learn_rate": params["learn_rate"], "trans_mode": params["trans_mode"],
+                                  "stop_policies": params["stop_policies"] or {}, "event_driven": params["event_driven"],
+                                  "edge_mode": params["edge_mode"],
+                                  "grid": grid_kind(params["grid"], params["width"], params["height"])})
+
+    @staticmethod
+    def snapshot_path(runs_path, run_id):
+
+        return os.path.join(runs_path, run_id + ".snapshot")
+
+    def snapshot_file(self):
+
+        return self.snapshot_path(self.runs_path, self.run_id)
+
+    def save_snapshot(self, path=None):
+
+        """ Saves the complete state of the run (agents, grid, schedule, random
+        number generators, counters and the edges recorded so far) so that it
+        can be continued later, in another process, with load_snapshot.
+        Defaults to <runs_path>/<run_id>.snapshot """
+
+        path = path or self.snapshot_file()
+
+        # Written under a temporary name first so that a run killed while
+        # saving still has its previous snapshot.
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load_snapshot(cls, path):
+
+        """ Returns the model saved in a snapshot. Calling step() continues the
+        run exactly where it was saved. """
+
+        with open(path, "rb") as f:
+            model = pickle.load(f)
+
+        if not isinstance(model, cls):
+            raise TypeError("%s holds a %s, not a %s" % (path, type(model).__name__, cls.__name__))
+
+        return model
+
+    def nearest_attractor_of(self, x, y):
+
+        return self.attractor_xy[nearest_attractor(x, y, self.attractor_x, self.attractor_y, self.draws.uniform)]
+
+    def schedule_events(self, agent, first_step):
+
+        """ Draws the time-steps of the death (inherited mode) and asocial
+        learning event (asocial modes) of a new monkey and adds them to the
+        event queues. first_step is the first time-step the monkey acts in. """
+
+        # Only the monkeys of the inherited mode grow old and die.
+        if self.transmission_mode == "inherited":
+            age = death_age_one(agent.age, self.draws.uniform())
+            self.deaths_due.push(first_step + age - agent.age - 1, agent.unique_id)
+
+        # A monkey is eligible from the time-step it is created in if it is old enough.
+        if self.asocial_events is True and agent.age >= 25 and agent.tool_user is False:
+            delay = learning_delay(self.asocial_rate/100, self.draws.uniform())
+            if delay is not None:
+                self.learning_due.push(first_step + delay - 1, agent.unique_id)
+
     def step(self):
         
-        self.n_users = compute_n_users(self)
-        self.n_w_trait = compute_n_w_trait(self)
+        if self.debug is True:
+            check_counters(self)
+
+        if self.profiler is not None:
+            self.profiler.begin_step(self)
+
+        self.n_users = self.n_tool_users
+        self.n_w_trait = self.n_trait_carriers
+        if self.event_driven is True:
+            self.dying_now = set(self.deaths_due.pop(self.timestep))
+            self.learning_now = set(self.learning_due.pop(self.timestep))
         self.schedule.step()
         self.timestep += 1
         
@@ -136,17 +308,22 @@ class Mendelian_Monkeys(Model):
             stop = True
             self.model_stop = "No more users"
 
-        elif len(self.schedule.agents) == 0:
+        elif self.n_living == 0:
             stop = True
             self.model_stop = "All Agents Dead"
         
         else: 
-            stop = False
+            reason = check_policies(self)
+            stop = reason is not None
+            if stop is True:
+                self.model_stop = reason
+
+        if self.profiler is not None:
+            self.profiler.end_step(self)
         
         if stop is True:
             
             # Print Summary Data
-            sum_path = os.path.join(self.runs_path, self.run_id + "_run_data.csv")
             run_sum = pd.DataFrame({'run_id': self.run_id,
                                     'datetime': self.datetime,
                                     'h': self.grid.height,
@@ -158,40 +335,36 @@ class Mendelian_Monkeys(Model):
                                     'a_learn_rate': self.asocial_rate,
                                     'attractor_strength': self.attractor_strength,
                                     'transmission_mech': self.transmission_mode,
-                                    'stop_reason': self.model_stop
+                                    'stop_reason': self.model_stop,
+                                    'seed': self.seed,
+                                    'stop_policies': json.dumps(self.stop_policy_spec),
+                                    'event_driven': self.event_driven,
+                                    'edge_mode': self.edge_mode,
+                                    'grid': "sparse" if self.grid.sparse else "dense"
                                     }, index=[0])
-            run_sum.to_csv(sum_path)
-            monkeys = [agent for agent in self.schedule.agents if isinstance(agent, Monkey)]
-            for agents in monkeys:
-                node_dat = {"id": agents.unique_id, 
-                            "run_id": self.run_id,
-                            "living": agents.living,
-                            "tool_user": agents.tool_user,
-                            "learned_tool_use": agents.tool_user,
-                            "tool_user_encounters": agents.tool_user_encounters,
-                            "age_learned_tool_use": agents.age_learned_tool_use,
-                            "time_step_learned": agents.ts_learned,
-                            "learning_method": agents.transmission_method,
-                            "age": agents.age,
-                            "mother": agents.mother,
-                            "mother_tool_user": agents.mother_tool_user,
-                            "hair": agents.hairpattern}
-
-                self.node_data.append(node_dat)
-            
-            nodes = pd.DataFrame(self.node_data)
-            node_path = os.path.join(self.runs_path, self.run_id + "_nodes.csv")
-            nodes.to_csv(node_path)
-
-            link_path = os.path.join(self.runs_path, self.run_id + "_social_edges.csv")
-            self.social_links.to_csv(link_path)
-
-            link_path = os.path.join(self.runs_path, self.run_id + "_genetic_edges.csv")
-            self.ancestry_links.to_csv(link_path)
+            for agents in self.schedule.agents:
+                self.node_log.append(agents)
+
+            tables = {"run_data": run_sum,
+                      "nodes": self.node_log.frames(),
+                      "social_" + self.social_links.suffix: self.social_links.to_frame(),
+                      "genetic_edges": self.ancestry_links.to_frame()}
+            if self.profiler is not None:
+                tables.update(self.profiler.tables())
+            if self.network_metrics is True:
+                tables["condition"] = logged_condition_table(self.run_id, self.node_log, self.social_links)
+            if self.write_edges is False:
+                del tables["social_" + self.social_links.suffix], tables["genetic_edges"]
+
+            self.output.write_run(self.run_id, tables)
+            self.node_log.close()
             self.running = False
 
-        else: 
-            pass
+            if self.snapshot_every and os.path.exists(self.snapshot_file()):
+                os.remove(self.snapshot_file()) # The run is complete, its snapshot is no longer needed.
+
+        elif self.snapshot_every and self.timestep % self.snapshot_every == 0:
+            self.save_snapshot()
 
 
 
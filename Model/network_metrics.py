@@ -0,0 +1,185 @@
+""" Social network measures of the monkeys of a run, in the layout of the
+Data/ABM_*_Condition.csv files analysed in Scripts/Reeves_et_al_2023_Analysis_Code.Rmd.
+This is what process_edges and mm_graph_prep in Scripts/helper_functions.R
+compute from the _nodes.csv and _social_edges.csv files of every run, done
+directly on the arrays of the run instead.
+
+One row per monkey that has at least one social edge:
+
+    run_id
+    U   1 if the monkey is a tool user, otherwise 0
+    C   eigenvector centrality in the weighted social network, scaled so the
+        most central monkey has 1. The network is treated as undirected, as
+        igraph's eigen_centrality does by default, and the weight of an edge
+        is the number of interactions between the pair.
+    S   strength of the monkey's ties to tool users (the summed weight of the
+        edges from tool users to the monkey), min-max scaled within the run
+    A   2 if the monkey is 25 or older, otherwise 1
+    H   phenotype: the hair pattern (1 or 2) of a juvenile, hair + 2 of an adult
+
+By default only the monkeys alive at the end of the run and the edges
+between them are used, which is what the published Condition tables hold. As
+in mm_graph_prep, a living monkey whose partners have all died keeps its row,
+as an isolated vertex with C = 0.
+
+The model writes this table itself, as the "condition" table of each run,
+when it is run with network_metrics = True. Runs already on disk can be
+processed with
+
+    python network_metrics.py <runs_path> [--output csv|sqlite|parquet] [--out ABM_Condition.csv] [--all]
+"""
+
+from edge_log import PAIR_STRIDE
+from output import get_backend, BACKENDS
+import pandas as pd
+import numpy
+import argparse
+
+COLUMNS = ["run_id", "U", "C", "S", "A", "H"]
+
+
+def edge_weights(source, target, weight=None):
+
+    """ Collapses repeated edges. Returns the distinct (source, target) pairs
+    and the number of times each occurs, or their summed weight if the edges
+    are weighted already. """
+
+    keys, inverse, counts = numpy.unique(source * PAIR_STRIDE + target, return_inverse=True, return_counts=True)
+    if weight is not None:
+        counts = numpy.bincount(inverse, weights=weight, minlength=len(keys)).astype(numpy.int64)
+    return keys // PAIR_STRIDE, keys % PAIR_STRIDE, counts
+
+
+def eigenvector_centrality(n, source, target, weight, tol=1e-10, max_iter=10000):
+
+    """ Returns the eigenvector centrality of the n nodes of the undirected
+    graph with the given weighted edges (node indices), scaled to a maximum of
+    1. Computed by power iteration on the sparse adjacency, shifted by the
+    identity so that it also converges on bipartite graphs. """
+
+    # Every edge counts in both directions.
+    rows = numpy.concatenate([source, target])
+    cols = numpy.concatenate([target, source])
+    weight = numpy.concatenate([weight, weight]).astype(float)
+
+    x = numpy.ones(n)
+    if n == 0:
+        return x
+
+    # Isolated nodes are 0, as in igraph, unless the graph has no edges at all (then every node is 1).
+    if len(rows) > 0:
+        x[numpy.bincount(rows, minlength=n) == 0] = 0
+
+    for i in range(max_iter):
+        y = x + numpy.bincount(rows, weights=weight * x[cols], minlength=n)
+        y /= y.max()
+        if numpy.abs(y - x).max() < tol:
+            return y
+        x = y
+
+    print("Warning! Eigenvector centrality did not converge in %d iterations" % max_iter)
+    return x
+
+
+def condition_table(run_id, ids, tool_user, age, hair, source, target, living=None, weight=None):
+
+    """ Returns the condition rows of a run. ids, tool_user, age and hair are
+    the node columns of the run, source and target the (unique ids of the)
+    social edges, with their weights if they were recorded as weighted edges.
+    If living is given, only the monkeys it flags and the edges between them
+    are used. """
+
+    ids = numpy.asarray(ids)
+    source = numpy.asarray(source, dtype=numpy.int64)
+    target = numpy.asarray(target, dtype=numpy.int64)
+
+    # The monkeys with at least one edge, in node table order. As in mm_graph_prep this
+    # is decided on all of the edges, before the edges to dead monkeys are dropped.
+    connected = numpy.isin(ids, source) | numpy.isin(ids, target)
+
+    if living is not None:
+        keep = numpy.asarray(living, dtype=bool)
+        ids, tool_user, age, hair = ids[keep], numpy.asarray(tool_user)[keep], numpy.asarray(age)[keep], numpy.asarray(hair)[keep]
+        connected = connected[keep]
+        known = numpy.isin(source, ids) & numpy.isin(target, ids)
+        source, target = source[known], target[known]
+        if weight is not None:
+            weight = numpy.asarray(weight)[known]
+
+    source, target, weight = edge_weights(source, target, weight)
+
+    # The node index of every edge end.
+    ids = ids[connected]
+    tool_user = numpy.asarray(tool_user, dtype=bool)[connected]
+    order = numpy.argsort(ids, kind="stable")
+    s = order[numpy.searchsorted(ids, source, sorter=order)]
+    t = order[numpy.searchsorted(ids, target, sorter=order)]
+
+    n = len(ids)
+    C = eigenvector_centrality(n, s, t, weight)
+
+    strength = numpy.bincount(t, weights=weight * tool_user[s], minlength=n)
+    S = strength
+    if n > 0:
+        # NaN when every monkey has the same strength, as in R.
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            S = (strength - strength.min()) / (strength.max() - strength.min())
+
+    A = numpy.where(numpy.asarray(age)[connected] >= 25, 2, 1)
+    hair = numpy.asarray(hair)[connected]
+
+    return pd.DataFrame({"run_id": run_id,
+                         "U": tool_user.astype(int),
+                         "C": C,
+                         "S": S,
+                         "A": A,
+                         "H": numpy.where(A == 1, hair, hair + 2)},
+                        columns=COLUMNS)
+
+
+def logged_condition_table(run_id, node_log, social_links, living=True):
+
+    """ Returns the condition rows of a run from its NodeLog and social EdgeLog """
+
+    nodes = node_log.records()
+    source, target, weight = social_links.weighted()
+    return condition_table(run_id, nodes["id"], nodes["tool_user"], nodes["age"], nodes["hair"],
+                           source, target, nodes["living"] if living else None, weight)
+
+
+def process_runs(runs_path, living=True, output="csv"):
+
+    """ Returns the condition rows of every run stored in runs_path by the
+    output backend output. Runs can have raw or weighted social edges. """
+
+    backend = get_backend(output, runs_path)
+
+    tables = []
+    for run_id in sorted(backend.finished_runs()):
+        run = backend.read_run(run_id, ["nodes", "social_edges", "social_edge_weights"])
+        nodes = run["nodes"]
+        # A weighted run has social_edge_weights instead (or, in a database, as well as an empty social_edges).
+        edges = run.get("social_edge_weights")
+        if edges is None or (len(edges) == 0 and "social_edges" in run):
+            edges = run["social_edges"]
+        tables.append(condition_table(run_id, nodes["id"].values, nodes["tool_user"].values, nodes["age"].values,
+                                      nodes["hair"].values, edges["source"].values.astype(numpy.int64),
+                                      edges["target"].values.astype(numpy.int64), nodes["living"].values if living else None,
+                                      edges["weight"].values if "weight" in edges.columns else None))
+
+    return pd.concat(tables, ignore_index=True) if len(tables) > 0 else pd.DataFrame(columns=COLUMNS)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Build the condition table of the runs in a folder")
+    parser.add_argument("runs_path")
+    parser.add_argument("--output", choices=sorted(BACKENDS), default="csv", help="the output backend the runs were written with")
+    parser.add_argument("--out", default="ABM_Condition.csv")
+    parser.add_argument("--all", action="store_true", help="include the monkeys that died during the run")
+    args = parser.parse_args()
+
+    table = process_runs(args.runs_path, living=not args.all, output=args.output)
+    table.index += 1 # Numbered from 1, as write.csv does
+    table.to_csv(args.out)
+    print("%d rows from %d runs written to %s" % (len(table), table["run_id"].nunique(), args.out))
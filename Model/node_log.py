@@ -0,0 +1,222 @@
+import pandas as pd
+import numpy
+import uuid
+import glob
+import os
+
+# Encodings of the string valued node attributes.
+
+LEARNING_METHODS = numpy.array(["Naive", "social", "inherited"], dtype=object)
+METHOD_CODES = {"Naive": 0, "social": 1, "inherited": 2}
+UNKNOWN = -1 # Stands for "Naive" (time-step learned) and "Unknown" (mother, mother's tool use)
+
+# One fixed width record per node. learned_tool_use is exported as a copy of
+# tool_user and is therefore not stored.
+
+NODE_DTYPE = numpy.dtype([("id", "i8"),
+                          ("living", "?"),
+                          ("tool_user", "?"),
+                          ("tool_user_encounters", "i8"),
+                          ("age_learned_tool_use", "i8"),
+                          ("time_step_learned", "i8"),
+                          ("learning_method", "i1"),
+                          ("age", "i8"),
+                          ("mother", "i8"),
+                          ("mother_tool_user", "i1"),
+                          ("hair", "i1")])
+
+
+def decode(values, missing, label):
+
+    """ Returns values as an object array where the entries flagged in missing
+    are replaced with label (e.g. "Naive" or "Unknown") """
+
+    out = values.astype(object)
+    out[missing] = label
+    return out
+
+
+def remove_spools(runs_path, run_id):
+
+    """ Removes the spool files left in runs_path by earlier attempts at run
+    run_id, which were killed or continued from a snapshot (under a new tag).
+    Only to be called while no attempt at the run is going on. """
+
+    for path in glob.glob(os.path.join(glob.escape(runs_path), ".%s_*_nodes.spool" % run_id)):
+        os.remove(path)
+
+
+class NodeLog:
+    """ Record of the nodes (one row per monkey, written when it dies and for
+    the survivors when the run ends). Rows are held in a fixed width buffer
+    of chunk_size records. Full chunks are appended to a spool file,
+    <runs_path>/.<run_id>_<tag>_nodes.spool, so memory use does not grow with
+    the length of the run. The table is read back chunk by chunk when the run
+    ends (see frames).
+
+    A NodeLog that is pickled with a model snapshot carries every record it
+    holds, the spooled ones included, so the snapshot does not depend on the
+    spool file and can be moved to another machine. An unpickled log never
+    touches the spool of the log it was pickled from: it holds the restored
+    records in memory and spools to a file of its own (a new tag) once its
+    buffer fills up. The spools of attempts that were killed are left behind,
+    see remove_spools. """
+
+    def __init__(self, runs_path, run_id, chunk_size=10000):
+
+        self.run_id = run_id
+        self.chunk_size = chunk_size
+        self.path = self.spool_path(runs_path)
+        self.buffer = numpy.zeros(chunk_size, dtype=NODE_DTYPE)
+        self.n_buffered = 0
+        self.n_spooled = 0
+        self.restored = self.buffer[:0] # Records restored from a snapshot that are not spooled yet.
+
+    def spool_path(self, runs_path):
+
+        return os.path.join(runs_path, ".%s_%s_nodes.spool" % (self.run_id, uuid.uuid4().hex[:8]))
+
+    def __len__(self):
+
+        return self.n_spooled + len(self.restored) + self.n_buffered
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state["restored"] = numpy.concatenate([self.spooled(), self.restored])
+        state["n_spooled"] = 0
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.path = self.spool_path(os.path.dirname(self.path))
+
+    def append(self, agent):
+
+        """ Records the node of a Monkey """
+
+        self.buffer[self.n_buffered] = (agent.unique_id,
+                                        agent.living,
+                                        agent.tool_user,
+                                        agent.tool_user_encounters,
+                                        agent.age_learned_tool_use,
+                                        agent.ts_learned_code,
+                                        agent.method_code,
+                                        agent.age,
+                                        agent.mother_id,
+                                        agent.mother_user_code,
+                                        agent.hairpattern)
+        self.n_buffered += 1
+
+        if self.n_buffered == self.chunk_size:
+            self.spool()
+
+    def extend(self, **columns):
+
+        """ Records a batch of nodes given as equal length arrays, one per field
+        of NODE_DTYPE, already encoded """
+
+        n = len(columns["id"])
+        records = numpy.zeros(n, dtype=NODE_DTYPE)
+        for field, values in columns.items():
+            records[field] = values
+
+        start = 0
+        while start < n:
+            take = min(n - start, self.chunk_size - self.n_buffered)
+            self.buffer[self.n_buffered:self.n_buffered + take] = records[start:start + take]
+            self.n_buffered += take
+            start += take
+            if self.n_buffered == self.chunk_size:
+                self.spool()
+
+    def spool(self):
+
+        with open(self.path, "ab" if self.n_spooled > 0 else "wb") as f:
+            # Records restored from a snapshot go first, they were written before the buffer.
+            if len(self.restored) > 0:
+                f.write(self.restored.tobytes())
+                self.n_spooled += len(self.restored)
+                self.restored = self.buffer[:0]
+            f.write(self.buffer[:self.n_buffered].tobytes())
+
+        self.n_spooled += self.n_buffered
+        self.n_buffered = 0
+
+    def to_frame(self, records, offset):
+
+        """ Returns records as a dataframe in the layout of the nodes table,
+        indexed from offset """
+
+        ts_learned = records["time_step_learned"]
+        mother = records["mother"]
+        mother_user = records["mother_tool_user"]
+
+        return pd.DataFrame({"id": records["id"],
+                             "run_id": self.run_id,
+                             "living": records["living"],
+                             "tool_user": records["tool_user"],
+                             "learned_tool_use": records["tool_user"],
+                             "tool_user_encounters": records["tool_user_encounters"],
+                             "age_learned_tool_use": records["age_learned_tool_use"],
+                             "time_step_learned": decode(ts_learned, ts_learned == UNKNOWN, "Naive"),
+                             "learning_method": LEARNING_METHODS[records["learning_method"]],
+                             "age": records["age"],
+                             "mother": decode(mother, mother == UNKNOWN, "Unknown"),
+                             "mother_tool_user": decode(mother_user == 1, mother_user == UNKNOWN, "Unknown"),
+                             "hair": records["hair"]},
+                            index=pd.RangeIndex(offset, offset + len(records)))
+
+    def spooled(self):
+
+        """ Returns the records written to the spool file """
+
+        if self.n_spooled == 0:
+            return self.buffer[:0]
+
+        records = numpy.fromfile(self.path, dtype=NODE_DTYPE, count=self.n_spooled)
+        self.check_spooled(len(records), self.n_spooled)
+        return records
+
+    def check_spooled(self, n_read, n_expected):
+
+        if n_read < n_expected:
+            raise RuntimeError("The node spool %s holds fewer records than were written to it (%d of %d)" %
+                               (self.path, n_read, n_expected))
+
+    def records(self):
+
+        """ Returns every record of the log as a single array """
+
+        return numpy.concatenate([self.spooled(), self.restored, self.buffer[:self.n_buffered]])
+
+    def frames(self):
+
+        """ Yields the nodes table chunk by chunk: spooled rows first, then
+        rows restored from a snapshot and the buffer """
+
+        offset = 0
+
+        if self.n_spooled > 0:
+            with open(self.path, "rb") as f:
+                while offset < self.n_spooled:
+                    count = min(self.chunk_size, self.n_spooled - offset)
+                    records = numpy.fromfile(f, dtype=NODE_DTYPE, count=count)
+                    self.check_spooled(offset + len(records), offset + count)
+                    yield self.to_frame(records, offset)
+                    offset += len(records)
+
+        for start in range(0, len(self.restored), self.chunk_size):
+            records = self.restored[start:start + self.chunk_size]
+            yield self.to_frame(records, offset)
+            offset += len(records)
+
+        yield self.to_frame(self.buffer[:self.n_buffered], offset)
+
+    def close(self):
+
+        """ Removes the spool file """
+
+        if os.path.isfile(self.path):
+            os.remove(self.path)
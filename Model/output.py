@@ -0,0 +1,382 @@
+""" Output backends. A model hands the tables of a finished run (run_data,
+nodes, social_edges, genetic_edges) to the backend selected with its
+`output` parameter:
+
+    "csv"     one csv file per table and run (<run_id>_<table>.csv). The default,
+              and the layout read by the analysis scripts in Scripts/.
+    "parquet" the tables of many runs are collected and written as a few large
+              parquet files with typed columns, one dataset directory per table.
+              Requires pyarrow.
+    "sqlite"  every run is written to <runs_path>/runs.sqlite in one transaction,
+              either directly or through a single writer process (see DB_QUEUE).
+
+A table is handed over either as a single dataframe or, when it can be too
+large to hold in memory at once (the nodes of a long run, see NodeLog), as an
+iterable of dataframe chunks. Every backend writes the chunks one at a time
+as they are read, so a run is never held in memory whole.
+
+Backends are opened once per process and output path and shared by every
+model run in that process (see get_backend). Every backend can also read the
+tables of a stored run back (read_run), e.g. for replay.py.
+"""
+
+from abm_functions import create_DB, add_run, connect_db, DB_TABLES
+from multiprocessing.util import Finalize
+import pandas as pd
+import sqlite3
+import atexit
+import uuid
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    import pyarrow.pandas_compat # Imported lazily by pyarrow otherwise, which fails when the first flush happens at exit.
+except ImportError:
+    pyarrow = None
+
+# Queue of a db_writer process (abm_functions.start_db_writer). When it is set
+# the sqlite backend sends its runs to the writer instead of writing them
+# itself. Worker processes either inherit it when they are forked or set it
+# with set_db_queue.
+
+DB_QUEUE = None
+
+
+def set_db_queue(queue):
+
+    global DB_QUEUE
+    DB_QUEUE = queue
+
+
+def chunks(table):
+
+    """ Returns a table as an iterable of dataframes """
+
+    return [table] if isinstance(table, pd.DataFrame) else table
+
+
+def typed_frame(table, frame, run_id):
+
+    """ Returns a copy of a run table with proper column types. The csv layout
+    mixes types within a column ("Naive" / time-step, "Unknown" / id, -1 for
+    missing ages, float ids for edges); here missing values become nulls and
+    every row carries its run_id. """
+
+    frame = frame.copy()
+
+    if table == "run_data":
+        frame["datetime"] = pd.to_datetime(frame["datetime"])
+
+    elif table == "nodes":
+        for column in ("living", "tool_user", "learned_tool_use"):
+            frame[column] = frame[column].astype(bool)
+        frame["time_step_learned"] = pd.to_numeric(frame["time_step_learned"], errors="coerce").astype("Int64")
+        frame["mother"] = pd.to_numeric(frame["mother"], errors="coerce").astype("Int64")
+        frame["mother_tool_user"] = frame["mother_tool_user"].map({True: True, False: False}).astype("boolean")
+        frame["age_learned_tool_use"] = frame["age_learned_tool_use"].astype("Int64").mask(frame["age_learned_tool_use"] == -1)
+        frame["learning_method"] = frame["learning_method"].astype(str)
+
+    elif table in ("social_edges", "genetic_edges"):
+        frame = frame.astype({"source": "int64", "target": "int64"})
+
+    if "run_id" not in frame.columns:
+        frame.insert(0, "run_id", run_id)
+
+    return frame.reset_index(drop=True)
+
+
+class CSVBackend:
+
+    """ Writes every table of a run to <runs_path>/<run_id>_<table>.csv """
+
+    name = "csv"
+
+    def __init__(self, runs_path):
+
+        self.runs_path = runs_path
+
+    def __reduce__(self):
+
+        # Backends hold process-local resources (files, connections, queues). A
+        # pickled model is given the backend of the process it is unpickled in.
+        return (get_backend, (self.name, self.runs_path))
+
+    def write_run(self, run_id, tables):
+
+        # Every file is written under a temporary name and then renamed, and
+        # the run_data file goes last: a run whose _run_data.csv exists is complete.
+        for table in sorted(tables, key=lambda table: table == "run_data"):
+            path = os.path.join(self.runs_path, run_id + "_" + table + ".csv")
+            for i, frame in enumerate(chunks(tables[table])):
+                frame.to_csv(path + ".tmp", mode="w" if i == 0 else "a", header=i == 0)
+            os.replace(path + ".tmp", path)
+
+    def finished_runs(self):
+
+        """ Returns the run_ids of the runs stored in runs_path """
+
+        return {name[:-len("_run_data.csv")] for name in os.listdir(self.runs_path) if name.endswith("_run_data.csv")}
+
+    def read_run(self, run_id, tables=None):
+
+        """ Returns the tables of a stored run (all of them, or the ones named
+        in tables) as a dict of dataframes. Raises KeyError if there is no
+        such run. """
+
+        if not os.path.isfile(os.path.join(self.runs_path, run_id + "_run_data.csv")):
+            raise KeyError("No run %s in %s" % (run_id, self.runs_path))
+
+        if tables is None:
+            prefix = run_id + "_"
+            tables = [name[len(prefix):-len(".csv")] for name in os.listdir(self.runs_path)
+                      if name.startswith(prefix) and name.endswith(".csv")]
+
+        return {table: pd.read_csv(os.path.join(self.runs_path, run_id + "_" + table + ".csv"), index_col=0)
+                for table in tables if os.path.isfile(os.path.join(self.runs_path, run_id + "_" + table + ".csv"))}
+
+    def close(self):
+
+        pass
+
+
+class ParquetBackend:
+
+    """ Writes the tables of many runs to <runs_path>/<table>/part-<writer>-<n>.parquet,
+    starting new files every runs_per_file runs. Each directory can be read as
+    a single dataset, e.g. with arrow::open_dataset() in R or pyarrow.dataset
+    in python.
+
+    Every chunk of a table is appended to the open file as a row group of its
+    own. The files keep a hidden name until they are complete, and the
+    run_data rows (one per run) are only written then, so readers never see a
+    partial run. Open files are completed when the backend is closed: by
+    close_backends(), at interpreter exit, or when a multiprocessing worker
+    shuts down normally. Workers that are killed lose the runs of their open
+    files. """
+
+    name = "parquet"
+
+    def __init__(self, runs_path, runs_per_file=250):
+
+        if pyarrow is None:
+            raise ImportError("The parquet output backend requires pyarrow")
+
+        self.runs_path = runs_path
+        self.runs_per_file = runs_per_file
+        self.writer = uuid.uuid4().hex[:8] # Keeps the files of different processes apart.
+        self.n_files = 0
+        self.n_buffered = 0
+        self.run_data = []
+        self.writers = {}
+
+        atexit.register(self.close)
+        Finalize(None, self.close, exitpriority=10)
+
+    def __reduce__(self):
+
+        return (get_backend, (self.name, self.runs_path))
+
+    def file_name(self, table, hidden):
+
+        name = "part-%s-%05d.parquet" % (self.writer, self.n_files)
+        return os.path.join(self.runs_path, table, "." + name if hidden else name)
+
+    def write_chunk(self, table, frame):
+
+        if len(frame) == 0:
+            return
+
+        if table not in self.writers:
+            # The first chunk sets the column types of the file.
+            os.makedirs(os.path.join(self.runs_path, table), exist_ok=True)
+            data = pyarrow.Table.from_pandas(frame, preserve_index=False)
+            self.writers[table] = pyarrow.parquet.ParquetWriter(self.file_name(table, True), data.schema)
+        else:
+            data = pyarrow.Table.from_pandas(frame, schema=self.writers[table].schema, preserve_index=False)
+
+        self.writers[table].write_table(data)
+
+    def write_run(self, run_id, tables):
+
+        for table, frames in tables.items():
+            for frame in chunks(frames):
+                frame = typed_frame(table, frame, run_id)
+                if table == "run_data":
+                    self.run_data.append(frame)
+                else:
+                    self.write_chunk(table, frame)
+
+        self.n_buffered += 1
+        if self.n_buffered >= self.runs_per_file:
+            self.flush()
+
+    def flush(self):
+
+        self.write_chunk("run_data", pd.concat(self.run_data, ignore_index=True))
+
+        for table, writer in self.writers.items():
+            writer.close()
+            os.replace(self.file_name(table, True), self.file_name(table, False))
+
+        self.n_files += 1
+        self.n_buffered = 0
+        self.run_data = []
+        self.writers = {}
+
+    def finished_runs(self):
+
+        """ Returns the run_ids of the runs written to the run_data dataset.
+        Runs still held in a buffer are not included. """
+
+        folder = os.path.join(self.runs_path, "run_data")
+        if not os.path.isdir(folder):
+            return set()
+
+        return set(pyarrow.parquet.read_table(folder, columns=["run_id"]).column("run_id").to_pylist())
+
+    def read_run(self, run_id, tables=None):
+
+        """ As CSVBackend.read_run. Runs still held in a buffer are not included. """
+
+        if run_id not in self.finished_runs():
+            raise KeyError("No run %s in %s" % (run_id, self.runs_path))
+
+        if tables is None:
+            tables = [name for name in os.listdir(self.runs_path) if os.path.isdir(os.path.join(self.runs_path, name))]
+
+        frames = {}
+        for table in tables:
+            folder = os.path.join(self.runs_path, table)
+            if os.path.isdir(folder):
+                data = pyarrow.parquet.read_table(folder, filters=[("run_id", "==", run_id)])
+                if data.num_rows > 0 or table == "run_data":
+                    frames[table] = data.to_pandas()
+
+        return frames
+
+    def close(self):
+
+        if self.n_buffered > 0:
+            self.flush()
+
+
+class SQLiteBackend:
+
+    """ Writes every run to <runs_path>/runs.sqlite, in a single transaction
+    per run. If DB_QUEUE is set the runs are sent to the writer process
+    instead, so that many workers can feed one database. """
+
+    name = "sqlite"
+
+    def __init__(self, runs_path, db_name="runs.sqlite"):
+
+        self.runs_path = runs_path
+        self.db_file = os.path.join(runs_path, db_name)
+        self.queue = DB_QUEUE
+        self.conn = None
+
+        if self.queue is None:
+            self.conn = create_DB(self.db_file)
+
+    def __reduce__(self):
+
+        return (get_backend, (self.name, self.runs_path))
+
+    def rows(self, run_id, table, frames):
+
+        """ Yields the chunks of a table as (columns, rows) pairs """
+
+        for frame in chunks(frames):
+            frame = typed_frame(table, frame, run_id)
+            if table == "run_data":
+                frame["datetime"] = frame["datetime"].astype(str)
+            frame = frame.astype(object).where(frame.notna(), None)
+            yield list(frame.columns), list(frame.itertuples(index=False, name=None))
+
+    def write_run(self, run_id, tables):
+
+        # run_data goes last: the writer process commits a run when its run_data row arrives.
+        order = sorted(tables, key=lambda table: table == "run_data")
+
+        if self.queue is not None:
+            self.queue.put(("start", run_id))
+            for table in order:
+                for columns, rows in self.rows(run_id, table, tables[table]):
+                    self.queue.put(("rows", run_id, table, columns, rows))
+        else:
+            add_run(self.conn, run_id, {table: self.rows(run_id, table, tables[table]) for table in order})
+
+    def finished_runs(self):
+
+        """ Returns the run_ids of the runs stored in the database """
+
+        if not os.path.isfile(self.db_file):
+            return set()
+
+        conn = connect_db(self.db_file)
+        try:
+            return {run_id for (run_id,) in conn.execute("SELECT run_id FROM run_data")}
+        except sqlite3.OperationalError: # The writer has not created the tables yet
+            return set()
+        finally:
+            conn.close()
+
+    def read_run(self, run_id, tables=None):
+
+        """ As CSVBackend.read_run. Without tables, the tables that hold no
+        rows of the run are left out. """
+
+        if run_id not in self.finished_runs():
+            raise KeyError("No run %s in %s" % (run_id, self.db_file))
+
+        conn = connect_db(self.db_file)
+        try:
+            frames = {}
+            for table in (DB_TABLES if tables is None else tables):
+                if table not in DB_TABLES:
+                    raise ValueError("Unknown table %r" % table)
+                frame = pd.read_sql_query("SELECT * FROM %s WHERE run_id = ?" % table, conn, params=(run_id,))
+                if tables is not None or len(frame) > 0:
+                    frames[table] = frame
+            return frames
+        finally:
+            conn.close()
+
+    def close(self):
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+BACKENDS = {"csv": CSVBackend,
+            "parquet": ParquetBackend,
+            "sqlite": SQLiteBackend}
+
+_open_backends = {}
+
+
+def get_backend(output, runs_path):
+
+    """ Returns the backend of type output for runs_path, opening it on first use """
+
+    if output not in BACKENDS:
+        raise ValueError("Unknown output backend %r, expected one of %s" % (output, sorted(BACKENDS)))
+
+    # Keyed by process too: a worker forked after the parent opened a backend
+    # must not write through the parent's copy.
+    key = (output, os.path.abspath(runs_path), os.getpid())
+    if key not in _open_backends:
+        _open_backends[key] = BACKENDS[output](runs_path)
+
+    return _open_backends[key]
+
+
+def close_backends():
+
+    """ Writes out anything the open backends still hold """
+
+    for backend in _open_backends.values():
+        backend.close()
+    _open_backends.clear()
@@ -0,0 +1,128 @@
+""" Opt-in timing of a model run. With profile = True, Mendelian_Monkeys uses
+the classes below instead of Monkey and RandomActivation. They time every
+phase of a step and count the events of every time-step, and the model writes
+two extra tables when the run ends:
+
+    phase_times   wall time and number of calls of each phase of the run
+                  (move, move_2, social_interaction, reproduce, learn, grow,
+                  the whole schedule and the model level work in
+                  Mendelian_Monkeys.step).
+    step_metrics  one row per time-step: population size, births, deaths,
+                  learning events, new social and genetic edges and the wall
+                  time of the step.
+
+A model run without profiling does not touch any of this.
+"""
+
+from agents import Monkey
+from mesa.time import RandomActivation
+from time import perf_counter
+import pandas as pd
+
+AGENT_PHASES = ("move", "move_2", "social_interaction", "reproduce", "learn", "grow")
+
+
+class StepProfiler:
+
+    def __init__(self):
+
+        self.seconds = {} # phase -> accumulated wall time
+        self.calls = {} # phase -> number of calls
+        self.steps = [] # per time-step metrics
+        self.learn_events = 0
+        self.deaths = 0
+
+    def add(self, phase, seconds):
+
+        self.seconds[phase] = self.seconds.get(phase, 0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def begin_step(self, model):
+
+        self.learn_events = 0
+        self.deaths = 0
+        self.n_social = len(model.social_links)
+        self.n_genetic = len(model.ancestry_links)
+        self.start = perf_counter()
+
+    def end_step(self, model):
+
+        seconds = perf_counter() - self.start
+        self.add("model", seconds - model.schedule.last_step_seconds)
+
+        births = len(model.ancestry_links) - self.n_genetic
+
+        self.steps.append((model.timestep, model.n_living, births, self.deaths, self.learn_events,
+                           len(model.social_links) - self.n_social, births, seconds))
+
+    def tables(self):
+
+        """ Returns the phase_times and step_metrics tables of the run """
+
+        phases = [phase for phase in AGENT_PHASES + ("schedule", "model") if phase in self.calls]
+
+        phase_times = pd.DataFrame({"phase": phases,
+                                    "calls": [self.calls[phase] for phase in phases],
+                                    "seconds": [self.seconds[phase] for phase in phases]})
+
+        step_metrics = pd.DataFrame(self.steps, columns=["timestep", "population", "births", "deaths", "learn_events",
+                                                         "social_edges", "genetic_edges", "seconds"])
+
+        return {"phase_times": phase_times, "step_metrics": step_metrics}
+
+
+def timed(phase, method):
+
+    """ Wraps a Monkey method so that its wall time is added to the model's profiler """
+
+    def wrapper(self, *args, **kwargs):
+
+        start = perf_counter()
+        result = method(self, *args, **kwargs)
+        self.model.profiler.add(phase, perf_counter() - start)
+        return result
+
+    return wrapper
+
+
+class ProfiledMonkey(Monkey):
+
+    """ A Monkey whose phases are timed. Behaves exactly like Monkey and
+    draws the same random numbers. """
+
+    __slots__ = ()
+
+    move = timed("move", Monkey.move)
+    move_2 = timed("move_2", Monkey.move_2)
+    social_interaction = timed("social_interaction", Monkey.social_interaction)
+    reproduce = timed("reproduce", Monkey.reproduce)
+
+    timed_learn = timed("learn", Monkey.learn)
+    timed_grow = timed("grow", Monkey.grow)
+
+    def learn(self, friend, lr_multiplier = 5):
+
+        was_user = self.tool_user
+        self.timed_learn(friend, lr_multiplier)
+        if self.tool_user is True and was_user is False:
+            self.model.profiler.learn_events += 1
+
+    def grow(self):
+
+        self.timed_grow()
+        if self.living is False:
+            self.model.profiler.deaths += 1
+
+
+class ProfiledActivation(RandomActivation):
+
+    """ RandomActivation that times each of its steps """
+
+    last_step_seconds = 0
+
+    def step(self):
+
+        start = perf_counter()
+        super().step()
+        self.last_step_seconds = perf_counter() - start
+        self.model.profiler.add("schedule", self.last_step_seconds)
@@ -0,0 +1,119 @@
+""" Re-runs a single finished run exactly, using the parameters and seed
+recorded in its run data. Useful for investigating one slow or odd run out
+of a sweep without re-running the whole sweep. The run data is read from
+whichever output the run was written to (csv files, runs.sqlite or parquet),
+or the one given with --output.
+
+    python replay.py <run_id> [--runs-path Model_2_Revisions] [--output sqlite] [--out PATH] [--vectorized] [--max-steps N]
+
+The replayed run writes its files to <runs-path>/replay unless --out is given,
+so the original output is never overwritten.
+"""
+
+from model_definition import Mendelian_Monkeys
+from vectorized_model import Vectorized_Monkeys
+from output import get_backend, BACKENDS
+import pandas as pd
+import argparse
+import inspect
+import json
+import os
+
+# Columns of _run_data.csv and the model parameter each of them records.
+
+RUN_DATA_PARAMS = {"h": "height",
+                   "w": "width",
+                   "n_agents": "Na",
+                   "starting_users": "N_Starting_Tool_users",
+                   "n_attractors": "N_Resources",
+                   "a_learn_rate": "learn_rate",
+                   "attractor_strength": "attraction",
+                   "transmission_mech": "trans_mode",
+                   "seed": "seed",
+                   "stop_policies": "stop_policies",
+                   "event_driven": "event_driven",
+                   "edge_mode": "edge_mode",
+                   "grid": "grid"}
+
+# Columns recorded as JSON, and as 0/1 in a database
+
+JSON_COLUMNS = ("stop_policies",)
+BOOL_COLUMNS = ("event_driven",)
+
+
+def find_output(run_id, runs_path):
+
+    """ Returns the output backend run_id was written with, going by the files in runs_path """
+
+    if os.path.isfile(os.path.join(runs_path, run_id + "_run_data.csv")):
+        return "csv"
+    if os.path.isfile(os.path.join(runs_path, "runs.sqlite")):
+        return "sqlite"
+    if os.path.isdir(os.path.join(runs_path, "run_data")):
+        return "parquet"
+    raise FileNotFoundError("No output of run %s found in %s" % (run_id, runs_path))
+
+
+def read_run_data(run_id, runs_path, output=None):
+
+    """ Returns the recorded summary of a run as a dict """
+
+    if output is None:
+        output = find_output(run_id, runs_path)
+
+    run_data = get_backend(output, runs_path).read_run(run_id, ["run_data"])["run_data"]
+    row = run_data.iloc[0]
+    return {column: getattr(row[column], "item", lambda: row[column])() for column in run_data.columns}
+
+
+def replay(run_id, runs_path, out_path=None, model_cls=Mendelian_Monkeys, max_steps=None, output=None):
+
+    """ Re-runs run_id and returns the model. Prints a warning if the replay
+    does not end the way the recorded run did. """
+
+    recorded = read_run_data(run_id, runs_path, output)
+
+    if "seed" not in recorded:
+        raise ValueError("%s was run before seeds were recorded and cannot be replayed" % run_id)
+
+    # Runs written before a column was added to the run data are replayed with the parameter's default.
+    # Parameters the engine does not take (grid for Vectorized_Monkeys) are left out.
+    accepted = inspect.signature(model_cls).parameters
+    params = {param: recorded[column] for column, param in RUN_DATA_PARAMS.items()
+              if column in recorded and not pd.isna(recorded[column]) and param in accepted}
+    for column in JSON_COLUMNS + BOOL_COLUMNS:
+        param = RUN_DATA_PARAMS[column]
+        if param in params:
+            params[param] = json.loads(params[param]) if column in JSON_COLUMNS else bool(params[param])
+
+    if out_path is None:
+        out_path = os.path.join(runs_path, "replay")
+
+    model = model_cls(runs_path=out_path, **params)
+
+    while model.running and (max_steps is None or model.timestep < max_steps):
+        model.step()
+
+    if model.run_id != run_id or (not model.running and
+                                  (model.timestep != recorded["n_time_steps"] or model.model_stop != recorded["stop_reason"])):
+        print("Warning! Replay of %s does not match the recorded run (%s time-steps, %s; recorded %s, %s). "
+              "Was it run with the other engine or an older version of the model?" %
+              (run_id, model.timestep, model.model_stop, recorded["n_time_steps"], recorded["stop_reason"]))
+
+    return model
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Re-run a single run from its recorded seed")
+    parser.add_argument("run_id")
+    parser.add_argument("--runs-path", default="Model_2_Revisions")
+    parser.add_argument("--output", choices=sorted(BACKENDS), default=None, help="where the run was written (found from the files by default)")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--vectorized", action="store_true", help="the run was made with Vectorized_Monkeys")
+    parser.add_argument("--max-steps", type=int, default=None)
+    args = parser.parse_args()
+
+    model_cls = Vectorized_Monkeys if args.vectorized else Mendelian_Monkeys
+    model = replay(args.run_id, args.runs_path, args.out, model_cls, args.max_steps, args.output)
+    print("%s: %s time-steps, %s" % (model.run_id, model.timestep, model.model_stop))
@@ -0,0 +1,269 @@
+from mesa.time import BaseScheduler
+from vectorized_model import Vectorized_Monkeys, POPULATION
+from abm_functions import new_seed
+from hazards import ASOCIAL_MODES
+import numpy
+
+# Keys of the (replicate, unique_id) pairs are replicate * ID_STRIDE + unique_id.
+
+ID_STRIDE = 2**40
+
+
+class Replicated_Monkeys(Vectorized_Monkeys):
+
+    """ Runs many independent replicates of one configuration of
+    Vectorized_Monkeys side by side. The populations of all of the replicates
+    are stacked in one set of arrays, in blocks ordered by replicate (rep holds
+    the replicate of every monkey), so each phase of a time-step is applied to
+    every replicate at once and the per step overhead is shared by all of
+    them. This pays off for small populations (e.g. Na = 100 on a 20x20 grid),
+    where a single run spends most of its time outside NumPy.
+
+    Every replicate is a Vectorized_Monkeys of its own, with its own seed,
+    run_id, random number generator, edge and node logs and stop policies, and
+    only borrows the stacked arrays. Each replicate draws from its own
+    generator in exactly the same order as it would on its own, so replicate
+    r of a batch writes the same output as Vectorized_Monkeys(seed = seeds[r])
+    and can be replayed with replay.py --vectorized. A replicate that meets its
+    stopping criteria writes its output and leaves the batch; the batch runs
+    until every replicate has stopped.
+
+    Either seeds (one per replicate) or the number of replicates (with fresh
+    seeds) is given. The other parameters are those of Vectorized_Monkeys. """
+
+    def __init__(self,
+                 height, width, Na, N_Starting_Tool_users = 1,
+                 N_Resources = 0, attraction = 5, learn_rate = 1,
+                 trans_mode = "social", runs_path = "Test", debug = False, seeds = None,
+                 replicates = None, output = "csv", stop_policies = None, network_metrics = False, write_edges = True,
+                 edge_mode = "raw", event_driven = False):
+
+        if seeds is None:
+            if replicates is None:
+                raise ValueError("Give either the seeds of the replicates or their number")
+            seeds = [new_seed() for i in range(replicates)]
+
+        self.replicates = [Vectorized_Monkeys(height, width, Na, N_Starting_Tool_users, N_Resources, attraction,
+                                              learn_rate, trans_mode, runs_path, debug, seed, output, stop_policies,
+                                              network_metrics, write_edges, edge_mode, event_driven)
+                           for seed in seeds]
+        self.live = list(range(len(self.replicates))) # Indices of the replicates that are still running.
+
+        self.running = True
+        self.timestep = 0
+        self.Na = Na
+        self.Nr = N_Resources
+        self.asocial_rate = learn_rate
+        self.attractor_strength = attraction
+        self.transmission_mode = trans_mode
+        self.debug = debug
+        self.event_driven = event_driven
+        self.asocial_events = event_driven is True and trans_mode in ASOCIAL_MODES
+        self.width = width
+        self.height = height
+        self.schedule = BaseScheduler(self)
+
+        # The batch holds the populations while the replicates run. A replicate
+        # gets its own arrays back when it stops.
+        self.rep = numpy.repeat(numpy.arange(len(self.replicates)), [replicate.n_living for replicate in self.replicates])
+        for field in POPULATION:
+            setattr(self, field, numpy.concatenate([getattr(replicate, field) for replicate in self.replicates]))
+            for replicate in self.replicates:
+                setattr(replicate, field, None)
+
+        if self.transmission_mode == "resource_attraction":
+            self.nearest_attractor = numpy.stack([replicate.nearest_attractor for replicate in self.replicates])
+            self.attractor_x = numpy.stack([replicate.attractor_x for replicate in self.replicates])
+            self.attractor_y = numpy.stack([replicate.attractor_y for replicate in self.replicates])
+
+    def counts(self, who=None):
+
+        """ Returns the number of monkeys at positions who (all of the monkeys
+        if who is None) in each replicate """
+
+        return numpy.bincount(self.rep if who is None else self.rep[who], minlength=len(self.replicates))
+
+    def blocks(self, who):
+
+        """ Yields (replicate, slice of who) for every running replicate. who
+        must list the monkeys replicate by replicate, as the population arrays
+        and the activation order do. """
+
+        counts = self.counts(who).tolist()
+        start = 0
+        for r in self.live:
+            yield self.replicates[r], slice(start, start + counts[r])
+            start += counts[r]
+
+    def draw(self, who, draw):
+
+        """ Returns draw(rng, size) of every running replicate for the monkeys
+        at positions who, in order """
+
+        # Sizes are passed as python ints, numpy's generators are much slower with
+        # numpy integers. An empty draw leaves a generator untouched, so replicates
+        # with nothing to draw are skipped.
+        counts = self.counts(who).tolist()
+        parts = [draw(self.replicates[r].rng, counts[r]) for r in self.live if counts[r] > 0]
+        if len(parts) == 0:
+            return draw(self.replicates[self.live[0]].rng, 0)
+        return numpy.concatenate(parts)
+
+## Random draws and lookups, per replicate
+
+    def activation_order(self):
+
+        counts = self.counts()
+        starts = (numpy.cumsum(counts) - counts).tolist()
+        counts = counts.tolist()
+        return numpy.concatenate([self.replicates[r].rng.permutation(counts[r]) + starts[r] for r in self.live])
+
+    def uniform(self, who=None):
+
+        return self.draw(who, lambda rng, size: rng.random(size))
+
+    def integers(self, low, high, who=None):
+
+        return self.draw(who, lambda rng, size: rng.integers(low, high, size=size))
+
+    def locate_mothers(self):
+
+        key = self.rep * ID_STRIDE + self.ids
+        query = self.rep * ID_STRIDE + self.mother
+        mom = numpy.searchsorted(key, query).clip(0, max(self.n_living - 1, 0))
+        return mom, key[mom] == query
+
+    def nearest_attractors(self, who):
+
+        rep = self.rep[who]
+        target = self.nearest_attractor[rep, self.x[who], self.y[who]]
+        return self.attractor_x[rep, target], self.attractor_y[rep, target]
+
+    def cells(self):
+
+        return (self.rep * self.width + self.x) * self.height + self.y
+
+    def new_ids(self, mothers):
+
+        ids = []
+        for replicate, block in self.blocks(mothers):
+            ids.append(replicate.new_ids(mothers[block]))
+        return numpy.concatenate(ids)
+
+    def add_edges(self, log, source, target, who):
+
+        for replicate, block in self.blocks(who):
+            getattr(replicate, log).extend(source[block], target[block], self.timestep)
+
+    def due(self, queue):
+
+        due = numpy.zeros(self.n_living, dtype=bool)
+        for replicate, block in self.blocks(numpy.arange(self.n_living)):
+            due[block] = numpy.isin(self.ids[block], getattr(replicate, queue).pop(self.timestep))
+        return due
+
+    def add_events(self, queue, steps, ids, who):
+
+        for replicate, block in self.blocks(who):
+            getattr(replicate, queue).extend(steps[block], ids[block])
+
+## Phases, per replicate
+
+    def births(self, has_mate, dies):
+
+        """ Vectorized_Monkeys.births within each replicate. The activation
+        order runs through the replicates in the same blocks as the population
+        arrays, so rep also gives the replicate of every entry of has_mate. """
+
+        counts = self.counts()
+        start = (numpy.cumsum(counts) - counts)[self.rep] # First entry of each monkey's block
+
+        def cumsum(values):
+            total = numpy.cumsum(values)
+            return total - (total - values)[start]
+
+        deaths_before = cumsum(dies) - dies
+        slack = self.Na - counts[self.rep] + deaths_before
+        mated = cumsum(has_mate)
+        headroom = slack - mated
+
+        # A running minimum per block: later blocks are shifted down by more than
+        # the range of headroom so that no block sees the minimum of an earlier one.
+        if len(headroom) > 0:
+            shift = self.rep * (int(headroom.max() - headroom.min()) + 1)
+            headroom = numpy.minimum.accumulate(headroom - shift) + shift
+
+        born = mated + numpy.minimum(0, headroom)
+        before = numpy.r_[0, born[:-1]]
+        before[start == numpy.arange(len(start))] = 0
+        return born - before > 0
+
+    def reproduce(self, mothers, mates):
+
+        offspring = super().reproduce(mothers, mates)
+        offspring["rep"] = self.rep[mothers]
+        return offspring
+
+    def record_nodes(self, idx, living, node_log=None):
+
+        for replicate, block in self.blocks(idx):
+            super().record_nodes(idx[block], living, replicate.node_log)
+
+    def keep(self, alive, offspring):
+
+        super().keep(alive, offspring)
+
+        # The offspring were appended at the end; put them back in the block of
+        # their replicate, after its survivors.
+        if len(offspring["ids"]) > 0:
+            order = numpy.argsort(self.rep, kind="stable")
+            for field in POPULATION + ("rep",):
+                setattr(self, field, getattr(self, field)[order])
+
+    def check_arrays(self, n):
+
+        lengths = set(len(getattr(self, field)) for field in POPULATION + ("rep",))
+        key = self.rep * ID_STRIDE + self.ids
+        if lengths != {self.n_living} or (self.counts() > self.Na).any() or (numpy.diff(key) <= 0).any():
+            raise RuntimeError("Population arrays are inconsistent at time-step %s" % self.timestep)
+
+    def retire(self, r):
+
+        """ Hands replicate r its population back and writes its output """
+
+        replicate = self.replicates[r]
+        block = self.rep == r
+        for field in POPULATION:
+            setattr(replicate, field, getattr(self, field)[block])
+        replicate.schedule.steps = replicate.schedule.time = self.timestep
+        replicate.finish()
+
+    def step(self):
+
+        users = self.counts(self.tool_user)
+        carriers = self.counts(self.tool_trait)
+        for r in self.live:
+            self.replicates[r].n_users = int(users[r])
+            self.replicates[r].n_w_trait = int(carriers[r])
+
+        self.advance()
+
+        counts = self.counts()
+        stopped = []
+        for r in self.live:
+            replicate = self.replicates[r]
+            replicate.timestep = self.timestep
+            reason = replicate.stop_reason(int(counts[r]))
+            if reason is not None:
+                replicate.model_stop = reason
+                self.retire(r)
+                stopped.append(r)
+
+        if len(stopped) > 0:
+            self.live = [r for r in self.live if r not in stopped]
+            kept = ~numpy.isin(self.rep, stopped)
+            for field in POPULATION + ("rep",):
+                setattr(self, field, getattr(self, field)[kept])
+
+        if len(self.live) == 0:
+            self.running = False
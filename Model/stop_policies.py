@@ -0,0 +1,175 @@
+""" Optional stopping rules for runs that would otherwise drift for a very long
+time without reaching one of the model's own stopping criteria (half of the
+population using tools, no users or trait carriers left, extinction).
+
+Policies are given to the model as a dict of name -> setting, e.g.
+
+    Mendelian_Monkeys(..., stop_policies = {"stall": 5000, "wall_clock": 3600})
+
+where the setting is either the policy's first argument or a dict of its
+keyword arguments. The dict is plain data, so it can be one of the parameters
+of a sweep. The policies are checked, in the order given, after the model's
+own criteria, and the first one that fires ends the run. Its reason is
+written to the stop_reason column of the run data, e.g.
+"Stalled (n_users unchanged for 5000 time-steps)".
+
+    wall_clock   seconds      wall time spent stepping the run
+    step_budget  steps        number of time-steps. Unlike the max_steps of a
+                              sweep, the run is ended properly and its output
+                              written.
+    stall        window       n_users has not changed for window time-steps
+    plateau      window,      the least squares trend of n_users over the
+                 tolerance,   last window time-steps is not significantly
+                 z            different from zero (|slope| <= z standard
+                              errors) and would change n_users by less than
+                              tolerance * Na over the window
+"""
+
+from collections import deque
+from time import perf_counter
+import numpy
+
+
+class StopPolicy:
+
+    """ A stopping rule. check is called once at the end of every time-step and
+    returns the reason for stopping the run, or None to carry on. start is
+    called once, when the model has been set up. """
+
+    def start(self, model):
+
+        pass
+
+    def check(self, model):
+
+        return None
+
+
+class WallClock(StopPolicy):
+
+    def __init__(self, seconds):
+
+        self.seconds = seconds
+        self.elapsed = 0 # Wall time spent stepping the run so far.
+        self.last = None
+
+    def __getstate__(self):
+
+        # A run restored from a snapshot does not count the time it spent on disk.
+        state = self.__dict__.copy()
+        state["last"] = None
+        return state
+
+    def check(self, model):
+
+        now = perf_counter()
+        if self.last is not None:
+            self.elapsed += now - self.last
+        self.last = now
+
+        if self.elapsed >= self.seconds:
+            return "Wall clock budget reached (%g s)" % self.seconds
+
+    def start(self, model):
+
+        self.last = perf_counter()
+
+
+class StepBudget(StopPolicy):
+
+    def __init__(self, steps):
+
+        self.steps = steps
+
+    def check(self, model):
+
+        if model.timestep >= self.steps:
+            return "Step budget reached (%d time-steps)" % self.steps
+
+
+class Stall(StopPolicy):
+
+    def __init__(self, window):
+
+        self.window = window
+        self.value = None # n_users when it last changed
+        self.since = 0 # time-step at which it last changed
+
+    def check(self, model):
+
+        if model.n_users != self.value:
+            self.value = model.n_users
+            self.since = model.timestep
+        elif model.timestep - self.since >= self.window:
+            return "Stalled (n_users unchanged for %d time-steps)" % self.window
+
+
+class Plateau(StopPolicy):
+
+    def __init__(self, window, tolerance=.01, z=2):
+
+        self.window = window
+        self.tolerance = tolerance
+        self.z = z
+        self.history = deque(maxlen=window) # n_users of the last window time-steps
+        self.every = max(1, window // 10) # The trend is only tested every few time-steps.
+
+        # The time-steps of the window, centred, and their sum of squares never change.
+        self.t = numpy.arange(window) - (window - 1)/2
+        self.sxx = float(numpy.sum(self.t**2))
+
+    def check(self, model):
+
+        self.history.append(model.n_users)
+
+        if len(self.history) < self.window or model.timestep % self.every != 0 or self.window < 3:
+            return None
+
+        y = numpy.fromiter(self.history, dtype=float, count=self.window)
+        slope = float(numpy.dot(self.t, y))/self.sxx
+        residuals = y - y.mean() - slope*self.t
+        se = (float(numpy.dot(residuals, residuals))/(self.window - 2)/self.sxx)**.5
+
+        if abs(slope) <= self.z*se and abs(slope)*self.window < self.tolerance*model.Na:
+            return "Plateau (n_users trend %.3g per time-step over %d time-steps)" % (slope, self.window)
+
+
+POLICIES = {"wall_clock": WallClock,
+            "step_budget": StepBudget,
+            "stall": Stall,
+            "plateau": Plateau}
+
+
+def make_policies(spec):
+
+    """ Returns the policies described by spec, a dict of name -> setting (see
+    above), in order """
+
+    if not spec:
+        return []
+
+    policies = []
+    for name, setting in spec.items():
+        if name not in POLICIES:
+            raise ValueError("Unknown stop policy %r, expected one of %s" % (name, sorted(POLICIES)))
+        if isinstance(setting, dict):
+            policies.append(POLICIES[name](**setting))
+        else:
+            policies.append(POLICIES[name](setting))
+
+    return policies
+
+
+def check_policies(model):
+
+    """ Returns the reason of the first of the model's policies that ends the
+    run, or None. Every policy is checked so that all of them see every
+    time-step. """
+
+    reason = None
+    for policy in model.stop_policies:
+        result = policy.check(model)
+        if reason is None:
+            reason = result
+
+    return reason
@@ -0,0 +1,259 @@
+""" Parallel parameter sweeps. Replaces mesa's BatchRunnerMP, which is gone
+from current versions of mesa.
+
+Every combination of the variable parameters is run `iterations` times on a
+pool of long-lived worker processes. Each run writes its own output through
+the model's output backend as soon as it ends, so the only thing sent back to
+the parent is a small status record per run.
+
+Every planned run, with its seed, is recorded in a manifest in the output
+folder (sweep_manifest.sqlite). Running the same sweep again after it was
+killed only runs what is missing: runs that are recorded as done and whose
+output is on disk are skipped, everything else is run again from its
+recorded seed.
+
+Sweeps of Vectorized_Monkeys can be given replicates = R to run the
+iterations of a parameter set R at a time, side by side in one
+Replicated_Monkeys (see replicated_model.py). Each replicate is still a run of
+its own, with its own seed and manifest entry, and writes the same output it
+would have written alone.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.util import Finalize
+from abm_functions import start_db_writer, stop_db_writer, new_seed
+from output import set_db_queue, close_backends, get_backend
+from node_log import remove_spools
+from model_definition import Mendelian_Monkeys
+from vectorized_model import Vectorized_Monkeys
+from replicated_model import Replicated_Monkeys
+from itertools import product
+import sqlite3
+import json
+import os
+
+# Model class of a worker process, set once by init_worker.
+
+_model_cls = None
+
+
+def init_worker(model_cls, db_queue):
+
+    """ Runs once in every worker process """
+
+    global _model_cls
+    _model_cls = model_cls
+    set_db_queue(db_queue)
+
+    # Buffered output is written out when the pool shuts the worker down.
+    Finalize(None, close_backends, exitpriority=10)
+
+
+def run_one(task):
+
+    """ Runs a single model and returns its status record """
+
+    task_id, params, seed, max_steps = task
+
+    # A long run that was interrupted continues from its last snapshot.
+    snapshot = None
+    if params.get("snapshot_every"):
+        snapshot = _model_cls.snapshot_path(params["runs_path"], _model_cls.run_id_for(seed, **params))
+
+    if snapshot is not None and os.path.isfile(snapshot):
+        model = _model_cls.load_snapshot(snapshot)
+    else:
+        model = _model_cls(seed=seed, **params)
+
+    while model.running and model.timestep < max_steps:
+        model.step()
+
+    return status_record(task_id, model)
+
+
+def run_replicates(task):
+
+    """ Runs the replicates of one parameter set side by side and returns
+    their status records """
+
+    task_ids, params, seeds, max_steps = task
+
+    batch = Replicated_Monkeys(seeds=seeds, **params)
+
+    while batch.running and batch.timestep < max_steps:
+        batch.step()
+
+    return [status_record(task_id, replicate) for task_id, replicate in zip(task_ids, batch.replicates)]
+
+
+def status_record(task_id, model):
+
+    return {"task_id": task_id,
+            "run_id": model.run_id,
+            "n_time_steps": model.timestep,
+            "stop_reason": model.model_stop if not model.running else "Max steps reached"}
+
+
+def run_task(task):
+
+    """ Runs one task of a sweep, a single run or a batch of replicates, and
+    returns the status records of its runs """
+
+    return run_replicates(task) if isinstance(task[0], list) else [run_one(task)]
+
+
+def run_chunk(tasks):
+
+    return [status for task in tasks for status in run_task(task)]
+
+
+def param_sets(fixed_params, variable_params):
+
+    """ Returns one parameter dict per combination of the variable parameters,
+    in the order BatchRunner used """
+
+    names = list(variable_params)
+    return [dict(fixed_params, **dict(zip(names, values)))
+            for values in product(*(variable_params[name] for name in names))]
+
+
+class SweepManifest:
+
+    """ Ledger of the runs planned by the sweeps writing to runs_path. A run
+    is identified by its model, its parameters and its iteration number. Only
+    the parent process of a sweep writes to it. """
+
+    def __init__(self, runs_path, name="sweep_manifest.sqlite"):
+
+        self.conn = sqlite3.connect(os.path.join(runs_path, name))
+
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS runs (
+                                    task_id integer PRIMARY KEY,
+                                    model text NOT NULL,
+                                    params text NOT NULL,
+                                    iteration integer NOT NULL,
+                                    seed integer NOT NULL,
+                                    status text NOT NULL,
+                                    output text,
+                                    runs_path text,
+                                    run_id text,
+                                    n_time_steps integer,
+                                    stop_reason text,
+                                    UNIQUE (model, params, iteration)
+                                );""")
+
+    def plan(self, model_name, params, iterations):
+
+        """ Records the runs of one parameter set that are not planned yet and
+        returns (task_id, iteration, seed, status, run_id, n_time_steps) for
+        every iteration """
+
+        key = json.dumps(params, sort_keys=True)
+
+        with self.conn:
+            for iteration in range(iterations):
+                self.conn.execute("INSERT OR IGNORE INTO runs (model, params, iteration, seed, status, output, runs_path) "
+                                  "VALUES (?, ?, ?, ?, 'planned', ?, ?)",
+                                  (model_name, key, iteration, new_seed(), params.get("output", "csv"), params["runs_path"]))
+
+        return self.conn.execute("SELECT task_id, iteration, seed, status, run_id, n_time_steps FROM runs "
+                                 "WHERE model = ? AND params = ? AND iteration < ? ORDER BY iteration",
+                                 (model_name, key, iterations)).fetchall()
+
+    def finish(self, status):
+
+        """ Records the status record returned by a finished run """
+
+        with self.conn:
+            self.conn.execute("UPDATE runs SET status = ?, run_id = ?, n_time_steps = ?, stop_reason = ? WHERE task_id = ?",
+                              ("max_steps" if status["stop_reason"] == "Max steps reached" else "done",
+                               status["run_id"], status["n_time_steps"], status["stop_reason"], status["task_id"]))
+
+    def close(self):
+
+        self.conn.close()
+
+
+def run_sweep(model_cls, fixed_params, variable_params, iterations=1, max_steps=1000000000, n_processes=None,
+              replicates=1):
+
+    """ Runs every parameter combination `iterations` times, skipping the runs
+    an earlier, interrupted call already completed. Returns the status records
+    of the runs made by this call. With replicates > 1 (Vectorized_Monkeys
+    only) the iterations of a parameter set are run that many at a time in
+    one process. """
+
+    if replicates > 1 and model_cls is not Vectorized_Monkeys:
+        raise ValueError("Replicates can only be batched for Vectorized_Monkeys, not %s" % model_cls.__name__)
+    if not issubclass(model_cls, Mendelian_Monkeys) and any(params.get("snapshot_every")
+                                                            for params in param_sets(fixed_params, variable_params)):
+        raise ValueError("Snapshots (snapshot_every) are only taken by Mendelian_Monkeys, not %s" % model_cls.__name__)
+
+    runs_path = fixed_params["runs_path"]
+    manifest = SweepManifest(runs_path)
+
+    # Runs recorded as done are only skipped if their output really is on disk,
+    # e.g. the parquet backend loses its buffered runs if a worker is killed.
+    backend = get_backend(fixed_params.get("output", "csv"), runs_path)
+    finished = backend.finished_runs()
+
+    tasks = []
+    n_runs = 0
+    for params in param_sets(fixed_params, variable_params):
+        todo = []
+        for task_id, iteration, seed, status, run_id, n_time_steps in manifest.plan(model_cls.__name__, params, iterations):
+            if (status == "done" and run_id in finished) or (status == "max_steps" and n_time_steps >= max_steps):
+                continue
+            run_id = model_cls.run_id_for(seed, **params)
+            if status == "planned" and run_id in finished:
+                # The run ended after the last status of its chunk was recorded
+                # (the sweep was killed): its output is on disk.
+                run_data = backend.read_run(run_id, ["run_data"])["run_data"].iloc[0]
+                manifest.finish({"task_id": task_id, "run_id": run_id, "n_time_steps": int(run_data["n_time_steps"]),
+                                 "stop_reason": run_data["stop_reason"]})
+                continue
+            # Node spools left behind by an earlier attempt at the run that was killed.
+            remove_spools(runs_path, run_id)
+            todo.append((task_id, seed))
+        n_runs += len(todo)
+
+        if replicates > 1:
+            for i in range(0, len(todo), replicates):
+                task_ids, seeds = zip(*todo[i:i + replicates])
+                tasks.append((list(task_ids), params, list(seeds), max_steps))
+        else:
+            tasks.extend((task_id, params, seed, max_steps) for task_id, seed in todo)
+
+    n_processes = n_processes or os.cpu_count()
+
+    # Tasks are handed to the workers in chunks: a few chunks per worker keeps
+    # the queue traffic down while still balancing runs of very uneven length.
+    chunksize = max(1, len(tasks) // (n_processes * 4))
+    chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+
+    print("%d runs to do" % n_runs)
+
+    db_writer, db_queue = None, None
+    if fixed_params.get("output") == "sqlite":
+        # A single process writes to the database, fed by all of the workers.
+        db_writer, db_queue = start_db_writer(os.path.join(runs_path, "runs.sqlite"))
+
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=init_worker,
+                                 initargs=(model_cls, db_queue)) as executor:
+            # The statuses of a chunk are recorded as soon as it ends: a sweep that is
+            # killed only loses the chunks in progress.
+            for future in as_completed([executor.submit(run_chunk, chunk) for chunk in chunks]):
+                for status in future.result():
+                    manifest.finish(status)
+                    results.append(status)
+                    print("%d/%d %s: %s time-steps, %s" % (len(results), n_runs, status["run_id"],
+                                                         status["n_time_steps"], status["stop_reason"]))
+    finally:
+        if db_writer is not None:
+            stop_db_writer(db_writer, db_queue)
+        manifest.close()
+
+    return results
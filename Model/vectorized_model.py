@@ -0,0 +1,627 @@
+from mesa import Model
+from mesa.time import BaseScheduler
+from abm_functions import make_run_id, nearest_attractor_table, new_seed
+from edge_log import EdgeLog, EDGE_LOGS
+from node_log import NodeLog, METHOD_CODES, UNKNOWN
+from output import get_backend
+from network_metrics import logged_condition_table
+from stop_policies import make_policies, check_policies
+from hazards import EventQueue, ASOCIAL_MODES, death_age, learning_delay
+from datetime import datetime
+import pandas as pd
+import json
+import numpy
+import random
+import inspect
+import os
+
+# Offsets of the Moore neighbourhood in the order mesa's grids return the
+# neighbouring cells (sorted by x and then by y).
+
+MOORE = numpy.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+MOORE_NO_CENTER = MOORE[MOORE.any(axis=1)]
+
+# When a monkey shares a cell with its mother all four orthogonal cells are
+# equally near. Monkey.move takes the first of them in mesa's order.
+
+ORTHOGONAL = numpy.array([(-1, 0), (0, -1), (0, 1), (1, 0)])
+
+# The population arrays, one entry per living monkey.
+
+POPULATION = ("ids", "x", "y", "age", "hair", "tool_user", "tool_trait", "learned", "encounters", "prox",
+              "age_learned", "ts_learned", "method", "mother", "mother_user")
+
+class Vectorized_Monkeys(Model):
+
+    """ Array backed version of Mendelian_Monkeys. The population is held as
+    a struct of NumPy arrays (one entry per living monkey, ordered by
+    unique_id) and every phase of a time-step is applied to all of the
+    monkeys at once. Takes the same parameters and writes the same csv files
+    as Mendelian_Monkeys.
+
+    The order in which the monkeys act within a time-step is drawn at random
+    every step but the phases are batched: every monkey moves, then
+    co-located monkeys interact, reproduce, learn and finally age and die.
+    The activation order is honoured where it matters for the dynamics (a
+    monkey follows its mother to the cell she has just moved into if she
+    acted first, and the population cap counts the births and deaths of the
+    monkeys that acted earlier); otherwise a monkey sees the state its
+    neighbours had at the start of the phase. equivalence_check.py compares
+    the two models."""
+
+    def __init__(self,
+                 height, width, Na, N_Starting_Tool_users = 1,
+                 N_Resources = 0, attraction = 5, learn_rate = 1,
+                 trans_mode = "social", runs_path = "Test", debug = False, seed = None,
+                 output = "csv", stop_policies = None, network_metrics = False, write_edges = True,
+                 edge_mode = "raw", event_driven = False):
+        self.runs_path = runs_path
+
+        # As in Mendelian_Monkeys every draw comes from generators seeded with the run's seed.
+        if seed is None:
+            seed = new_seed()
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.rng = numpy.random.default_rng(seed)
+
+        # As in Mendelian_Monkeys the run_id follows from the seed and the recorded settings.
+        self.run_id = self.run_id_for(seed, height=height, width=width, Na=Na, N_Starting_Tool_users=N_Starting_Tool_users,
+                                      N_Resources=N_Resources, attraction=attraction, learn_rate=learn_rate,
+                                      trans_mode=trans_mode, stop_policies=stop_policies, event_driven=event_driven,
+                                      edge_mode=edge_mode)
+        self.datetime = datetime.now()
+        self.starting_users = N_Starting_Tool_users # The number of individuals that begin with the tool use trait.
+        self.model_stop = -1 # This will be populated with the reason the simulation ended.
+        self.current_id = 0 # The id to be given to the next agent.
+        self.running = True # Determines if the model is running or not. This attribute is also handled by mesa
+        self.timestep = 0 # The current time-step of the simulation
+        self.Na = Na # The number of agents in the model.
+        self.Nr = N_Resources # The number of attractors within the model.
+        self.asocial_rate = learn_rate
+        self.attractor_strength = attraction
+        self.transmission_mode = trans_mode # how the tool use trait is transmitted from one individual to the other.
+        self.debug = debug # When True the population arrays are checked for consistency every time-step.
+        self.network_metrics = network_metrics # When True the social network measures of the run are written as its condition table (see network_metrics.py).
+        self.write_edges = write_edges # When False the social and genetic edge tables are not written.
+        self.event_driven = event_driven # When True deaths and asocial learning are drawn in advance (see hazards.py).
+        self.asocial_events = event_driven is True and trans_mode in ASOCIAL_MODES
+        self.deaths_due = EventQueue()
+        self.learning_due = EventQueue()
+        self.width = width
+        self.height = height
+
+        # The BatchRunner reads the number of steps taken from the schedule. No agents are added to it.
+        self.schedule = BaseScheduler(self)
+
+        self.node_log = NodeLog(self.runs_path, self.run_id) # Node records of the dead monkeys, and of the survivors once the run ends.
+        # Holds information on each interaction. Used to generate the social networks. Either every
+        # interaction (edge_mode = "raw") or their number per pair of monkeys ("weighted"), see edge_log.py.
+        if edge_mode not in EDGE_LOGS:
+            raise ValueError("Unknown edge_mode %r, expected one of %s" % (edge_mode, sorted(EDGE_LOGS)))
+        self.social_links = EDGE_LOGS[edge_mode]()
+        self.edge_mode = edge_mode
+        self.ancestry_links = EdgeLog() # Holds information on each repoductive event. Not used in the paper.
+
+        ## create agents
+
+        n_naive = Na - N_Starting_Tool_users
+        starting = numpy.arange(Na) >= n_naive
+
+        self.ids = numpy.arange(1, Na + 1, dtype=numpy.int64)
+        self.current_id = Na
+        self.x = numpy.where(starting, int(width/2), self.rng.integers(width, size=Na))
+        self.y = numpy.where(starting, int(height/2), self.rng.integers(height, size=Na))
+        self.age = numpy.where(starting, 25, self.rng.integers(0, 101, size=Na)) # random ages stop mass die off events
+        self.hair = numpy.where(starting, 2, self.rng.integers(1, 3, size=Na))
+        self.tool_user = starting.copy()
+        self.tool_trait = starting.copy()
+        self.learned = numpy.where(starting, 2, 0) # 0: False, 1: True, 2: "OG"
+        self.encounters = numpy.zeros(Na, dtype=numpy.int64)
+        self.prox = numpy.zeros(Na, dtype=numpy.int64)
+        self.age_learned = numpy.full(Na, -1, dtype=numpy.int64)
+        self.ts_learned = numpy.full(Na, UNKNOWN, dtype=numpy.int64) # UNKNOWN stands for "Naive"
+        self.method = numpy.zeros(Na, dtype=numpy.int64) # node_log.METHOD_CODES of the learning method
+        self.mother = numpy.full(Na, UNKNOWN, dtype=numpy.int64)
+        self.mother_user = numpy.full(Na, UNKNOWN, dtype=numpy.int64) # UNKNOWN, 0 (False) or 1 (True)
+
+        if self.transmission_mode == "resource_attraction":
+
+            # Attractor cells are sampled without replacement from the flattened grid.
+            cells = self.rng.choice(width * height, size=self.Nr, replace=False)
+            self.current_id += self.Nr
+            self.attractor_xy = [(int(c // height), int(c % height)) for c in cells]
+            self.attractor_x = cells // height
+            self.attractor_y = cells % height
+            self.nearest_attractor = nearest_attractor_table(width, height, self.attractor_xy, rng=self.rng)
+
+        if self.event_driven is True:
+            self.schedule_events(numpy.arange(Na), self.ids, self.age, self.tool_user, 0)
+
+        print(self.run_id)
+        if not os.path.exists(self.runs_path):
+            os.mkdir(self.runs_path)
+        else:
+            pass
+
+        self.output = get_backend(output, self.runs_path) # Where the tables of the run are written when it ends (see output.py).
+
+        # Extra stopping rules for runs that drift without reaching a conclusion (see stop_policies.py).
+        self.stop_policy_spec = stop_policies or {} # Recorded in the run data, so that replays stop the same way.
+        self.stop_policies = make_policies(stop_policies)
+        for policy in self.stop_policies:
+            policy.start(self)
+
+    @classmethod
+    def run_id_for(cls, seed, **params):
+
+        """ Returns the run_id of cls(seed = seed, **params) without building the model """
+
+        args = inspect.signature(cls).bind(seed=seed, **params)
+        args.apply_defaults()
+        params = args.arguments
+
+        return make_run_id(seed, {"engine": cls.__name__, "height": params["height"], "width": params["width"],
+                                  "Na": params["Na"], "N_Starting_Tool_users": params["N_Starting_Tool_users"],
+                                  "N_Resources": params["N_Resources"], "attraction": params["attraction"],
+                                  "learn_rate": params["learn_rate"], "trans_mode": params["trans_mode"],
+                                  "stop_policies": params["stop_policies"] or {}, "event_driven": params["event_driven"],
+                                  "edge_mode": params["edge_mode"]})
+
+    @property
+    def n_living(self):
+        return len(self.ids)
+
+    @property
+    def n_tool_users(self):
+        return int(self.tool_user.sum())
+
+    @property
+    def n_trait_carriers(self):
+        return int(self.tool_trait.sum())
+
+## Random draws and lookups
+#
+# Replicated_Monkeys (replicated_model.py) runs many replicates of this model
+# side by side in the same arrays and overrides the methods below so that each
+# replicate draws from its own generator.
+
+    def activation_order(self):
+
+        """ Returns the order the monkeys act in this time-step """
+
+        return self.rng.permutation(self.n_living)
+
+    def uniform(self, who=None):
+
+        """ Returns a uniform draw in [0, 1) for each of the monkeys at positions
+        who (all of the monkeys if who is None) """
+
+        return self.rng.random(self.n_living if who is None else len(who))
+
+    def integers(self, low, high, who=None):
+
+        """ As uniform, for integers in [low, high) """
+
+        return self.rng.integers(low, high, size=self.n_living if who is None else len(who))
+
+    def locate_mothers(self):
+
+        """ Returns the position of each monkey's mother and whether she is
+        alive. Mothers are found by searching the (sorted) ids of the living
+        monkeys. """
+
+        mom = numpy.searchsorted(self.ids, self.mother).clip(0, max(self.n_living - 1, 0))
+        return mom, self.ids[mom] == self.mother
+
+    def nearest_attractors(self, who):
+
+        """ Returns the x and y of the attractor nearest to each of the monkeys at positions who """
+
+        target = self.nearest_attractor[self.x[who], self.y[who]]
+        return self.attractor_x[target], self.attractor_y[target]
+
+    def cells(self):
+
+        """ Returns a key identifying the grid cell of each monkey """
+
+        return self.x * self.height + self.y
+
+    def new_ids(self, mothers):
+
+        """ Returns the unique ids of the offspring of mothers """
+
+        ids = numpy.arange(self.current_id + 1, self.current_id + len(mothers) + 1, dtype=numpy.int64)
+        self.current_id += len(mothers)
+        return ids
+
+    def add_edges(self, log, source, target, who):
+
+        """ Adds edges (unique ids) to the edge log named log. who holds the
+        positions of the monkeys the edges belong to. """
+
+        getattr(self, log).extend(source, target, self.timestep)
+
+    def due(self, queue):
+
+        """ Returns a mask of the monkeys whose event in the EventQueue named
+        queue is due this time-step """
+
+        return numpy.isin(self.ids, getattr(self, queue).pop(self.timestep))
+
+    def add_events(self, queue, steps, ids, who):
+
+        """ Adds events (time-steps and unique ids) to the EventQueue named
+        queue. who holds the positions of the monkeys the draws were made for. """
+
+        getattr(self, queue).extend(steps, ids)
+
+## Phases
+
+    def schedule_events(self, who, ids, age, tool_user, first_step):
+
+        """ Monkey.schedule_events for a batch of new monkeys (unique ids, ages
+        and tool use). The draws are made for the monkeys at positions who (the
+        monkeys themselves or their mothers). first_step is the first time-step
+        they act in. """
+
+        # Only the monkeys of the inherited mode grow old and die.
+        if self.transmission_mode == "inherited" and len(ids) > 0:
+            steps = first_step + death_age(age, self.uniform(who)) - age - 1
+            self.add_events("deaths_due", steps, ids, who)
+
+        # A monkey is eligible from the time-step it is created in if it is old enough.
+        eligible = (age >= 25) & ~tool_user
+        if self.asocial_events is True and eligible.any() and self.asocial_rate > 0:
+            delay = learning_delay(self.asocial_rate/100, self.uniform(who[eligible]))
+            self.add_events("learning_due", first_step + delay - 1, ids[eligible], who[eligible])
+
+    def random_steps(self, x, y, include_center):
+
+        """ Returns a uniformly drawn neighbouring cell inside the grid for
+        each (x, y). Draws that fall outside the grid are redrawn. """
+
+        offsets = MOORE if include_center else MOORE_NO_CENTER
+        new_x = x.copy()
+        new_y = y.copy()
+        todo = numpy.arange(len(x))
+
+        while len(todo) > 0:
+            pick = offsets[self.integers(0, len(offsets), todo)]
+            cx = x[todo] + pick[:, 0]
+            cy = y[todo] + pick[:, 1]
+            ok = (cx >= 0) & (cx < self.width) & (cy >= 0) & (cy < self.height)
+            new_x[todo[ok]] = cx[ok]
+            new_y[todo[ok]] = cy[ok]
+            todo = todo[~ok]
+
+        return new_x, new_y
+
+    def steps_toward(self, x, y, tx, ty, include_center):
+
+        """ Returns the neighbouring cell of each (x, y) that is nearest to
+        (tx, ty). Moving one cell along the sign of each axis is always the
+        unique nearest cell, unless the target is the cell itself. """
+
+        dx = numpy.sign(tx - x)
+        dy = numpy.sign(ty - y)
+
+        if not include_center:
+            same = numpy.flatnonzero((dx == 0) & (dy == 0))
+            for ox, oy in ORTHOGONAL[::-1]:
+                ok = (x[same] + ox >= 0) & (x[same] + ox < self.width) & (y[same] + oy >= 0) & (y[same] + oy < self.height)
+                dx[same[ok]] = ox
+                dy[same[ok]] = oy
+
+        return x + dx, y + dy
+
+    def move(self, activation):
+
+        """ Batched Monkey.move (mother following) and Monkey.move_2
+        (attractor following). activation holds the order in which the
+        monkeys act during this time-step. """
+
+        n = self.n_living
+        new_x, new_y = self.random_steps(self.x, self.y,
+                                         include_center = self.transmission_mode == "resource_attraction")
+
+        if self.transmission_mode == "resource_attraction":
+
+            follow = self.tool_user & (self.integers(1, 101) <= self.attractor_strength)
+            tx, ty = self.nearest_attractors(follow)
+            to_x, to_y = self.steps_toward(self.x[follow], self.y[follow], tx, ty,
+                                           include_center = True)
+            new_x[follow] = to_x
+            new_y[follow] = to_y
+
+        else:
+
+            mom, alive = self.locate_mothers()
+            has_mom = (self.mother != UNKNOWN) & alive
+            follow_prob = (1 - ((self.age * 2) / 100)).clip(0, None)
+            follow = has_mom & (self.uniform() < follow_prob)
+
+            # A monkey whose mother acted before it heads for the cell its mother
+            # has just moved into. Those moves are resolved in waves, once the
+            # mother's own move has been resolved.
+            rank = numpy.empty(n, dtype=numpy.int64)
+            rank[activation] = numpy.arange(n)
+            after_mom = follow & (rank[mom] < rank)
+            resolved = ~follow
+
+            while not resolved.all():
+                ready = numpy.flatnonzero(~resolved & (~after_mom | resolved[mom]))
+                m = mom[ready]
+                tx = numpy.where(after_mom[ready], new_x[m], self.x[m])
+                ty = numpy.where(after_mom[ready], new_y[m], self.y[m])
+                new_x[ready], new_y[ready] = self.steps_toward(self.x[ready], self.y[ready], tx, ty,
+                                                               include_center = False)
+                resolved[ready] = True
+
+        self.x = new_x
+        self.y = new_y
+
+    def pick_partners(self):
+
+        """ Returns, for each monkey, the index of a randomly chosen other
+        monkey occupying the same cell, or -1 if it is alone. """
+
+        n = self.n_living
+        cell = self.cells()
+        order = numpy.argsort(cell, kind="stable")
+        sorted_cells = cell[order]
+        starts = numpy.flatnonzero(numpy.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+        sizes = numpy.diff(numpy.r_[starts, n])
+        group = numpy.repeat(numpy.arange(len(starts)), sizes)
+
+        rank = numpy.arange(n) - starts[group]
+        size = sizes[group]
+
+        # A draw among the other size - 1 monkeys that skips the monkey itself.
+        pick = (self.uniform() * (size - 1)).astype(numpy.int64)
+        pick[pick >= rank] += 1
+
+        partners = numpy.full(n, -1, dtype=numpy.int64)
+        crowded = size > 1
+        partners[order[crowded]] = order[starts[group[crowded]] + pick[crowded]]
+        return partners
+
+    def births(self, has_mate, dies):
+
+        """ Returns a mask over the monkeys (in activation order) that give
+        birth. As in Monkey.step a monkey with a mate reproduces only while the
+        living population is below Na, counting the births and deaths of the
+        monkeys that acted before it.
+
+        With s the free places and P the number of monkeys with a mate so far,
+        the births B follow B[k] = min(B[k-1] + has_mate[k], s[k]). Since s
+        never decreases this is B[k] = P[k] + min(0, min over j <= k of s[j] - P[j]). """
+
+        deaths_before = numpy.cumsum(dies) - dies
+        slack = self.Na - len(has_mate) + deaths_before
+        mated = numpy.cumsum(has_mate)
+        born = mated + numpy.minimum(0, numpy.minimum.accumulate(slack - mated))
+        return numpy.diff(born, prepend=0) > 0
+
+    def reproduce(self, mothers, mates):
+
+        """ Returns the arrays of the offspring of each mother and mate pair. """
+
+        n = len(mothers)
+        hair_score = self.hair[mothers] + self.hair[mates]
+        hair = numpy.where(hair_score == 4, 2, numpy.where(hair_score == 2, 1, self.integers(1, 3, mothers)))
+        trait = (hair == 2) & (((self.tool_trait[mates]) & (self.hair[mates] == 2)) |
+                               ((self.tool_trait[mothers]) & (self.hair[mothers] == 2)))
+
+        ids = self.new_ids(mothers)
+        self.add_edges("ancestry_links", self.ids[mothers], ids, mothers)
+
+        return {"ids": ids,
+                "x": self.x[mothers],
+                "y": self.y[mothers],
+                "age": numpy.zeros(n, dtype=numpy.int64),
+                "hair": hair,
+                "tool_user": numpy.zeros(n, dtype=bool),
+                "tool_trait": trait,
+                "learned": numpy.zeros(n, dtype=numpy.int64),
+                "encounters": numpy.zeros(n, dtype=numpy.int64),
+                "prox": numpy.zeros(n, dtype=numpy.int64),
+                "age_learned": numpy.full(n, -1, dtype=numpy.int64),
+                "ts_learned": numpy.full(n, UNKNOWN, dtype=numpy.int64),
+                "method": numpy.zeros(n, dtype=numpy.int64),
+                "mother": self.ids[mothers],
+                "mother_user": self.tool_user[mothers].astype(numpy.int64)}
+
+    def learn(self, partners, was_user):
+
+        """ Batched Monkey.learn. was_user holds the tool use status of every
+        monkey at the start of the time-step. """
+
+        eligible = (self.age >= 25) & ~self.tool_user
+        if self.asocial_events is False:
+            x = self.uniform() * 100
+
+        if self.transmission_mode == "social":
+            friend_user = (partners >= 0) & was_user[partners.clip(0, None)]
+            learns = eligible & friend_user & (x < self.encounters * 5)
+
+        elif self.transmission_mode == "inherited":
+            learns = eligible & (x < 85) & self.tool_trait
+
+        elif self.transmission_mode == "asocial" or self.transmission_mode == "resource_attraction":
+            if self.asocial_events is True:
+                learns = eligible & self.due("learning_due") # Drawn in advance (see hazards.py)
+            else:
+                learns = eligible & (x <= self.asocial_rate)
+
+        else: # For debugging
+            print("Warning! No transmission mode selected! Debug Model")
+            self.running = False
+            return
+
+        self.tool_user[learns] = True
+        self.age_learned[learns] = self.age[learns]
+        self.learned[learns] = 1
+        self.ts_learned[learns] = self.timestep
+
+        # Asocial learning does not record a learning method in the object model.
+        if self.transmission_mode in METHOD_CODES:
+            self.method[learns] = METHOD_CODES[self.transmission_mode]
+
+    def record_nodes(self, idx, living, node_log=None):
+
+        """ Adds the node records of the monkeys at positions idx to the node log """
+
+        (self.node_log if node_log is None else node_log).extend(id=self.ids[idx],
+                             living=living,
+                             tool_user=self.tool_user[idx],
+                             tool_user_encounters=self.encounters[idx],
+                             age_learned_tool_use=self.age_learned[idx],
+                             time_step_learned=self.ts_learned[idx],
+                             learning_method=self.method[idx],
+                             age=self.age[idx],
+                             mother=self.mother[idx],
+                             mother_tool_user=self.mother_user[idx],
+                             hair=self.hair[idx])
+
+    def keep(self, alive, offspring):
+
+        """ Drops the dead monkeys and appends the offspring to the population arrays """
+
+        for field, values in offspring.items():
+            current = getattr(self, field)
+            setattr(self, field, numpy.concatenate([current[alive], values.astype(current.dtype)]))
+
+    def check_arrays(self, n):
+
+        """ Raises if the population arrays have gone out of step with each
+        other or the population has outgrown its cap. n is the population at
+        the start of the time-step. Only called in debug mode. """
+
+        lengths = set(len(getattr(self, field)) for field in POPULATION)
+        if lengths != {self.n_living} or self.n_living > max(self.Na, n):
+            raise RuntimeError("Population arrays are inconsistent at time-step %s" % self.timestep)
+
+    def advance(self):
+
+        """ Runs the phases of one time-step """
+
+        n = self.n_living
+        activation = self.activation_order() # The order the monkeys act in this time-step.
+        was_user = self.tool_user.copy()
+
+        #Move
+        self.move(activation)
+
+        #Interact Socially
+        partners = self.pick_partners()
+        acting = activation[partners[activation] >= 0]
+        self.prox[acting] += 1
+        self.encounters[acting] += was_user[partners[acting]]
+        self.add_edges("social_links", self.ids[partners[acting]], self.ids[acting], acting)
+
+        # Deaths are drawn up front (with the age the monkey will reach this
+        # time-step) because a death early in the activation order frees a
+        # place for a birth later in the same time-step.
+        dies = numpy.zeros(n, dtype=bool)
+        if self.transmission_mode == "inherited" and self.event_driven is True:
+            dies = self.due("deaths_due") # Drawn in advance (see hazards.py)
+        elif self.transmission_mode == "inherited":
+            death_prob = .0001 + (self.age + 1)/10000
+            dies = self.uniform() < death_prob
+
+        #Repoduce
+        mothers = activation[self.births(partners[activation] >= 0, dies[activation])]
+        offspring = self.reproduce(mothers, partners[mothers])
+        if self.event_driven is True:
+            self.schedule_events(mothers, offspring["ids"], offspring["age"], offspring["tool_user"], self.timestep + 1)
+
+        #learn
+        self.learn(partners, was_user)
+
+        #grow
+        if self.transmission_mode == "inherited":
+            self.age += 1
+            dead = activation[dies[activation]]
+            if len(dead) > 0:
+                self.record_nodes(dead, False)
+
+        self.keep(~dies, offspring)
+
+        if self.debug is True:
+            self.check_arrays(n)
+
+        self.schedule.step()
+        self.timestep += 1
+
+    def stop_reason(self, n_living):
+
+        """ Returns the reason the run ends after this time-step, or None if it
+        goes on. n_living is the population at the end of the time-step. """
+
+        # Stopping Critera
+        prop_users = self.n_users/self.Na
+        if prop_users >= .50:
+            return "Tool Pop Achieved"
+
+        elif self.transmission_mode == "social" and self.n_users == 0:
+            return "No more users"
+
+        elif self.transmission_mode == "inherited" and self.n_w_trait == 0:
+            return "No more users"
+
+        elif n_living == 0:
+            return "All Agents Dead"
+
+        else:
+            return check_policies(self)
+
+    def finish(self):
+
+        """ Writes the tables of the run and stops it """
+
+        # Print Summary Data
+        run_sum = pd.DataFrame({'run_id': self.run_id,
+                                'datetime': self.datetime,
+                                'h': self.height,
+                                "w": self.width,
+                                "starting_users": self.starting_users,
+                                'n_time_steps': self.timestep,
+                                'n_agents': self.Na,
+                                'n_attractors': self.Nr,
+                                'a_learn_rate': self.asocial_rate,
+                                'attractor_strength': self.attractor_strength,
+                                'transmission_mech': self.transmission_mode,
+                                'stop_reason': self.model_stop,
+                                'seed': self.seed,
+                                'stop_policies': json.dumps(self.stop_policy_spec),
+                                'event_driven': self.event_driven,
+                                'edge_mode': self.edge_mode,
+                                'grid': "dense" # The population arrays are indexed by cell like Mendelian_Monkeys' dense grid.
+                                }, index=[0])
+
+        self.record_nodes(numpy.arange(self.n_living), True)
+
+        tables = {"run_data": run_sum,
+                  "nodes": self.node_log.frames(),
+                  "social_" + self.social_links.suffix: self.social_links.to_frame(),
+                  "genetic_edges": self.ancestry_links.to_frame()}
+        if self.network_metrics is True:
+            tables["condition"] = logged_condition_table(self.run_id, self.node_log, self.social_links)
+        if self.write_edges is False:
+            del tables["social_" + self.social_links.suffix], tables["genetic_edges"]
+
+        self.output.write_run(self.run_id, tables)
+        self.node_log.close()
+        self.running = False
+
+    def step(self):
+
+        self.n_users = self.n_tool_users
+        self.n_w_trait = self.n_trait_carriers
+
+        self.advance()
+
+        reason = self.stop_reason(self.n_living)
+        if reason is not None:
+            self.model_stop = reason
+            self.finish()
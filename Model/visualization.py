@@ -21,15 +21,31 @@ def agent_portrayal(agent):
         if agent.learned_tool_use is True:
             portrayal["Color"] = "orange"
 
-    elif isinstance(agent, ToolResource):
-        portrayal["Color"] = "green"
-        portrayal["Layer"] = 0
+    return portrayal
 
 
-    return portrayal
+class AttractorCanvasGrid(CanvasGrid):
+
+    """ CanvasGrid that also draws the attractors, which are not agents on the
+    grid but a static layer of the model (Mendelian_Monkeys.attractor_xy) """
+
+    def render(self, model):
+
+        grid_state = super().render(model)
+
+        for x, y in getattr(model, "attractor_xy", []):
+            grid_state[0].append({"Shape": "circle",
+                                  "Color": "green",
+                                  "Filled": "true",
+                                  "Layer": 0,
+                                  "r": 1,
+                                  "x": x,
+                                  "y": y})
+
+        return grid_state
 
 
-grid = CanvasGrid(agent_portrayal, h, w)
+grid = AttractorCanvasGrid(agent_portrayal, h, w)
 
 server = ModularServer(Mendelian_Monkeys,
                        [grid],